@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+# Asynchronous variant of TeensyUSBProxy (based on trollius, the asyncio port
+# for Python 2)
+#
+# Commands are written to the stream as soon as they are issued, i.e., several
+# requests can be in flight. The Teensy answers requests in order, hence the
+# futures of pending requests are resolved in FIFO order as the response bytes
+# arrive.
+
+import collections, errno, os
+
+import trollius as asyncio
+from trollius import From, Return
+
+from teensy_usb_proxy import *
+
+class AsyncTeensyUSBProxy:
+    def __init__(self, reader, writer, shadow = False, loop = None):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop or asyncio.get_event_loop()
+
+        # used for encoding commands (and for the shadow registers)
+        self.proxy = TeensyUSBProxy(None, shadow)
+
+        self.closed = False
+        self.pending = collections.deque()
+        self.wakeup = asyncio.Event(loop = self.loop)
+        self.receiver = asyncio.ensure_future(self.receive(), loop = self.loop)
+
+    @asyncio.coroutine
+    def receive(self):
+        try:
+            while True:
+                while not self.pending:
+                    self.wakeup.clear()
+                    yield From(self.wakeup.wait())
+
+                n, future, decoder = self.pending[0]
+                data = yield From(self.reader.readexactly(n))
+                self.pending.popleft()
+
+                if not future.cancelled():
+                    future.set_result(decoder(data) if decoder else data)
+        except Exception as e:
+            # fail all pending requests (e.g., if the stream was closed), and
+            # the ones issued later
+            self.closed = True
+            while self.pending:
+                n, future, decoder = self.pending.popleft()
+                if not future.cancelled():
+                    future.set_exception(e)
+
+    # sends a command with a response of n bytes, returns a future of the
+    # (decoded) response
+    def request(self, cmd, n, decoder = None):
+        if self.closed:
+            raise IOError('connection closed')
+
+        future = asyncio.Future(loop = self.loop)
+        self.pending.append((n, future, decoder))
+        self.wakeup.set()
+        self.writer.write(cmd)
+        return future
+
+    # sends a command without response, returns a (completed) future so that
+    # writes can be awaited like reads
+    def send(self, cmd):
+        if cmd is not None:
+            self.writer.write(cmd)
+        future = asyncio.Future(loop = self.loop)
+        future.set_result(None)
+        return future
+
+    def read(self, reg, n = 1):
+        cmd = ''.join(self.proxy.command(CMD_READ, reg, min(n - i, MAX_COUNT))
+                for i in range(0, n, MAX_COUNT))
+        return self.request(cmd, n)
+
+    # returns a future of a dict mapping the registers to their values
+    def read_many(self, regs):
+        return self.request(self.proxy.gatherCommand(regs), len(regs),
+                lambda data: dict(zip(regs, map(ord, data))))
+
+    def write(self, reg, vals):
+        return self.send(self.proxy.writeCommand(reg, vals))
+
+    def modify(self, reg, clear, set):
+        return self.send(self.proxy.modifyCommand(reg, clear, set))
+
+    # waits until (reg & mask) != 0 or the timeout (in ms, None to wait
+    # forever) expires by re-issuing polls of at most POLL_TIMEOUT (see
+    # TeensyUSBProxy.waitForInterrupt()); returns the final value of reg
+    @asyncio.coroutine
+    def wait_for(self, reg, mask, timeout = None):
+        deadline = None if timeout is None else \
+                self.loop.time() + timeout / 1000.0
+        while True:
+            val = yield From(self.request(self.proxy.pollCommand(reg, mask,
+                POLL_TIMEOUT if timeout is None
+                else min(timeout, POLL_TIMEOUT)), 1, ord))
+            if val & mask or (deadline is not None and
+                    self.loop.time() >= deadline):
+                raise Return(val)
+
+    @asyncio.coroutine
+    def drain(self):
+        yield From(self.writer.drain())
+
+    def close(self):
+        self.closed = True
+        self.receiver.cancel()
+        self.writer.close()
+
+# Bidirectional transport for a serial port (the read and write pipe
+# transports of the event loop cannot share one file descriptor). Reads and
+# writes go to the non-blocking file descriptor of the port, data not written
+# at once is buffered until the port is writable.
+class SerialTransport(asyncio.Transport):
+    # the protocol is paused while more bytes are buffered
+    HIGH_WATER = 64 * 1024
+
+    def __init__(self, loop, protocol, ser):
+        asyncio.Transport.__init__(self, {'serial' : ser})
+        self.loop = loop
+        self.protocol = protocol
+        self.ser = ser
+        self.fd = ser.fileno()
+        self.buffer = []
+        self.buffered = 0
+        self.paused = False
+        self.closing = False
+
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(loop.add_reader, self.fd, self.readReady)
+
+    def readReady(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.fail(e)
+            return
+        if data:
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if not data or self.closing:
+            return
+
+        if not self.buffer:
+            n = self.writeSome(data)
+            if n is None or n == len(data):
+                return
+            data = data[n:]
+            self.loop.add_writer(self.fd, self.writeReady)
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered > self.HIGH_WATER and not self.paused:
+            self.paused = True
+            self.protocol.pause_writing()
+
+    # returns the number of bytes written (or None if the port failed)
+    def writeSome(self, data):
+        try:
+            return os.write(self.fd, data)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return 0
+            self.fail(e)
+            return None
+
+    def writeReady(self):
+        data = ''.join(self.buffer)
+        n = self.writeSome(data)
+        if n is None:
+            return
+        self.buffer = [data[n:]] if n < len(data) else []
+        self.buffered = len(data) - n
+        if self.buffer:
+            return
+
+        self.loop.remove_writer(self.fd)
+        if self.paused:
+            self.paused = False
+            self.protocol.resume_writing()
+        if self.closing:
+            self.loop.call_soon(self.finish, None)
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def can_write_eof(self):
+        return False
+
+    def is_closing(self):
+        return self.closing
+
+    # closes the port once the buffered data is written
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.fd)
+        if not self.buffer:
+            self.loop.call_soon(self.finish, None)
+
+    def abort(self):
+        self.fail(None)
+
+    def fail(self, exc):
+        if self.fd is None:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.buffer = []
+        self.buffered = 0
+        self.loop.call_soon(self.finish, exc)
+
+    def finish(self, exc):
+        if self.fd is None:
+            return
+        self.fd = None
+        try:
+            self.protocol.connection_lost(exc)
+        finally:
+            self.ser.close()
+
+# opens a serial port, returns an AsyncTeensyUSBProxy for it
+@asyncio.coroutine
+def open_serial(port, baudrate = 57600, shadow = False, loop = None):
+    import serial
+
+    loop = loop or asyncio.get_event_loop()
+    ser = serial.Serial(port, baudrate, timeout = 0)
+
+    reader = asyncio.StreamReader(loop = loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop = loop)
+    transport = SerialTransport(loop, protocol, ser)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    # let the protocol attach to the transport
+    yield From(asyncio.sleep(0, loop = loop))
+
+    raise Return(AsyncTeensyUSBProxy(reader, writer, shadow, loop))
+
+# connects to a serial port exported via TCP (e.g., by ser2net), returns an
+# AsyncTeensyUSBProxy for it
+@asyncio.coroutine
+def open_tcp(host, port, shadow = False, loop = None):
+    loop = loop or asyncio.get_event_loop()
+    reader, writer = yield From(asyncio.open_connection(host, port,
+        loop = loop))
+    raise Return(AsyncTeensyUSBProxy(reader, writer, shadow, loop))
+
+# stream writer for a SimulatedTeensy, responses are fed to reader
+class SimulatedWriter:
+    def __init__(self, sim, reader):
+        self.sim = sim
+        self.reader = reader
+
+    def write(self, data):
+        self.sim.write(data)
+        n = self.sim.inWaiting()
+        if n > 0:
+            self.reader.feed_data(self.sim.read(n))
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+    def close(self):
+        self.reader.feed_eof()
+
+# returns an AsyncTeensyUSBProxy for a SimulatedTeensy
+def open_simulated(sim, shadow = False, loop = None):
+    loop = loop or asyncio.get_event_loop()
+    reader = asyncio.StreamReader(loop = loop)
+    return AsyncTeensyUSBProxy(reader, SimulatedWriter(sim, reader), shadow,
+            loop)
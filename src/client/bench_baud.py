@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Benchmark of the serial link throughput at the baud rates supported by the
+# Teensy. For every rate, the simulated Teensy is switched to the rate (via
+# TeensyUSBProxy.set_baud()) and bulk reads, bulk writes and enumerations of
+# the HID keyboard are timed. Results are written as JSON.
+#
+# Without -d, the times are those of the modelled link: the bytes at the baud
+# rate plus a fixed latency per round-trip (of the USB serial adapter, see
+# -l). Bulk transfers thus approach baud/10 B/s, while round-trip bound
+# traffic like enumerations gains less from higher rates.
+
+import argparse, json, os, sys, time
+
+from teensy_sim import *
+from tracing import WARNING
+import bench_enumeration
+import usb_hid_keyboard as keyboard
+
+STATS = ['round_trips', 'bytes_sent', 'bytes_received', 'link_time']
+
+# runs f and returns the stats of the simulated link and the wall-clock time
+def measure(sim, f):
+    before = dict(sim.stats)
+    t = time.time()
+    f()
+    stats = dict((k, sim.stats[k] - before[k]) for k in STATS)
+    stats['time'] = time.time() - t
+    return stats
+
+def bench(baud, args):
+    sim = SimulatedTeensy(BOOT_BAUDRATE, args.delay, args.latency / 1000.0)
+    u = TeensyUSBProxy(sim, shadow = True)
+    if not u.set_baud(baud):
+        return None
+
+    u.write('UENUM', 0)
+    block = '\x00' * args.block
+
+    def reads():
+        for _ in range(args.blocks):
+            u.read('UEDATX', args.block)
+
+    def writes():
+        for _ in range(args.blocks):
+            u.write('UEDATX', block)
+
+    def enumerations():
+        u.init()
+        u.enable()
+        u.attach()
+        device = keyboard.HIDKeyboard(u)
+        for _ in range(args.runs):
+            bench_enumeration.runEnumeration(sim, device)
+
+    result = {
+            'baud'        : baud,
+            'actual_baud' : baudrate(ubrr(baud)),
+            }
+    for name, f in [('read', reads), ('write', writes),
+            ('enumeration', enumerations)]:
+        stats = measure(sim, f)
+        # the link time is simulated unless the simulator sleeps for it
+        t = stats['time'] if args.delay else stats['link_time']
+        stats['bytes_per_second'] = \
+                (stats['bytes_sent'] + stats['bytes_received']) / t
+        result[name] = stats
+    result['enumeration']['time_per_enumeration'] = \
+            (result['enumeration']['time'] if args.delay else
+                    result['enumeration']['link_time']) / args.runs
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-k', '--blocks', type = int, default = 16,
+            help = 'number of blocks read and written')
+    parser.add_argument('-s', '--block', type = int, default = 1024,
+            help = 'size of the blocks read and written')
+    parser.add_argument('-n', '--runs', type = int, default = 5,
+            help = 'number of enumerations')
+    parser.add_argument('-d', '--delay', action = 'store_true',
+            help = 'sleep for the simulated link time')
+    parser.add_argument('-l', '--latency', type = float, default = 1.0,
+            help = 'latency of a round-trip in ms')
+    parser.add_argument('-o', '--output', default = 'bench_baud.json',
+            help = 'JSON file to write the results to')
+    args = parser.parse_args()
+
+    keyboard.trace.setLevel(WARNING)
+
+    results = []
+    print '%8s %12s %12s %12s %12s' % ('baud', 'read [B/s]', 'write [B/s]',
+            'enum [B/s]', 'enum [ms]')
+    for baud in BAUDRATES:
+        result = bench(baud, args)
+        if result is None:
+            print '%8d %12s' % (baud, 'failed')
+            continue
+        results.append(result)
+        print '%8d %12.0f %12.0f %12.0f %12.3f' % (baud,
+                result['read']['bytes_per_second'],
+                result['write']['bytes_per_second'],
+                result['enumeration']['bytes_per_second'],
+                result['enumeration']['time_per_enumeration'] * 1000)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp' : time.time(),
+            'python'    : sys.version,
+            'delay'     : args.delay,
+            'latency'   : args.latency,
+            'blocks'    : args.blocks,
+            'block'     : args.block,
+            'runs'      : args.runs,
+            'results'   : results,
+            }, f, indent = 4, sort_keys = True)
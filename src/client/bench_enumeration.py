@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# Benchmark of the enumeration of the HID keyboard (usb_hid_keyboard.py)
+# against a simulated Teensy. For every request type, the serial round-trips,
+# the bytes sent and received, and the wall-clock time are reported. Results
+# are written as JSON for comparing runs.
+
+import argparse, json, os, sys, time
+
+from teensy_sim import *
+from link_trace import RecordingSerial
+from metrics import PeriodicDump
+from tracing import WARNING
+import usb_hid_keyboard as keyboard
+
+# requests as issued by a typical host during enumeration:
+# (name, bmRequestType, bRequest, wValue, wIndex, wLength)
+ENUMERATION = [
+        ('GET_DESCRIPTOR DEVICE',        0x80, 6, 0x0100, 0x0000, 64),
+        ('SET_ADDRESS',                  0x00, 5, 0x0001, 0x0000, 0),
+        ('GET_DESCRIPTOR DEVICE',        0x80, 6, 0x0100, 0x0000, 18),
+        ('GET_DESCRIPTOR CONFIGURATION', 0x80, 6, 0x0200, 0x0000, 9),
+        ('GET_DESCRIPTOR CONFIGURATION', 0x80, 6, 0x0200, 0x0000, 255),
+        ('GET_DESCRIPTOR STRING',        0x80, 6, 0x0300, 0x0000, 255),
+        ('GET_DESCRIPTOR STRING',        0x80, 6, 0x0302, 0x0409, 255),
+        ('GET_DESCRIPTOR STRING',        0x80, 6, 0x0301, 0x0409, 255),
+        ('SET_CONFIGURATION',            0x00, 9, 0x0001, 0x0000, 0),
+        ('GET_DESCRIPTOR Report',        0x81, 6, 0x2200, 0x0000, 255),
+        ]
+
+STATS = ['round_trips', 'bytes_sent', 'bytes_received', 'link_time',
+        'local_requests']
+
+# runs a single request, returns the stats of the simulated link, the
+# wall-clock time and the IN data sent by the device (a usb_device.USBDevice)
+def request(sim, device, bmRequestType, bRequest, wValue, wIndex, wLength):
+    before = dict(sim.stats)
+    t = time.time()
+
+    # requests answered by the firmware never reach the client
+    answered = sim.stats['local_requests']
+    sim.setup(bmRequestType, bRequest, wValue, wIndex, wLength)
+    while sim.stats['local_requests'] == answered and device.poll() is None:
+        continue
+
+    t = time.time() - t
+    stats = dict((k, sim.stats[k] - before[k]) for k in STATS)
+    stats['time'] = t
+    return stats, ''.join(sim.takeIn(0))
+
+def runEnumeration(sim, device):
+    sim.busReset()
+    device.poll()
+
+    results = []
+    for step in ENUMERATION:
+        stats, data = request(sim, device, *step[1:])
+        results.append((step[0], stats, data))
+    return results
+
+# detaches and attaches the device (in full, including the initialization of
+# the controller and the PLL), returns a result like runEnumeration()
+def reenumerate(sim, device, full = False):
+    before = dict(sim.stats)
+    t = time.time()
+
+    if full:
+        u = device.u
+        u.detach()
+        u.disable()
+        u.init()
+        u.enable()
+        u.attach()
+        u.configuration = None
+        device.reset()
+    else:
+        device.reenumerate()
+
+    t = time.time() - t
+    stats = dict((k, sim.stats[k] - before[k]) for k in STATS)
+    stats['time'] = t
+    return ('REENUMERATE', stats, '')
+
+def summarize(runs):
+    summary = {}
+    for results in runs:
+        for name, stats, data in results:
+            s = summary.setdefault(name, {'count' : 0, 'time_min' : None,
+                'time_max' : 0.0})
+            s['count'] += 1
+            for k in STATS + ['time']:
+                s[k] = s.get(k, 0) + stats[k]
+            if s['time_min'] is None or stats['time'] < s['time_min']:
+                s['time_min'] = stats['time']
+            s['time_max'] = max(s['time_max'], stats['time'])
+
+    for s in summary.values():
+        for k in STATS + ['time']:
+            s[k] = float(s[k]) / s['count']
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--runs', type = int, default = 20,
+            help = 'number of enumerations')
+    parser.add_argument('-b', '--baud', type = int, default = 57600,
+            help = 'baud rate of the simulated link')
+    parser.add_argument('-d', '--delay', action = 'store_true',
+            help = 'sleep for the simulated link time')
+    parser.add_argument('-s', '--shadow', action = 'store_true',
+            help = 'enable the shadow registers of the proxy')
+    parser.add_argument('-f', '--firmware', action = 'store_true',
+            help = 'answer standard requests from the descriptor store of '
+                   'the firmware')
+    parser.add_argument('-e', '--reenumerate', choices = ['fast', 'full'],
+            help = 'detach and attach the device before every enumeration '
+                   '(fast: TeensyUSBProxy.reenumerate(), full: detach, '
+                   'disable, init, enable, attach)')
+    parser.add_argument('-r', '--record',
+            help = 'record the serial link traffic to a trace file (not '
+                   'with -e)')
+    parser.add_argument('-m', '--metrics',
+            help = 'dump the link metrics as JSON lines to this file')
+    parser.add_argument('-i', '--interval', type = float, default = 1.0,
+            help = 'seconds between metrics dumps')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+            help = 'trace the requests handled by the keyboard')
+    parser.add_argument('-o', '--output', default = 'bench_enumeration.json',
+            help = 'JSON file to write the results to')
+    args = parser.parse_args()
+    if args.record and args.reenumerate:
+        # the replay (see link_trace.py) only polls the device, it cannot
+        # tell when to re-enumerate
+        parser.error('-r cannot be combined with -e')
+
+    sim = SimulatedTeensy(args.baud, args.delay)
+    ser = sim
+    if args.record:
+        ser = RecordingSerial(sim, open(args.record, 'wb'))
+    u = TeensyUSBProxy(ser, args.shadow)
+    u.init()
+    u.enable()
+    u.attach()
+
+    if not args.verbose:
+        keyboard.trace.setLevel(WARNING)
+    device = keyboard.HIDKeyboard(u)
+    if args.firmware:
+        device.upload()
+
+    if args.metrics:
+        dump = PeriodicDump(u.metrics, open(args.metrics, 'w'), args.interval)
+        dump.start()
+
+    # keep the traced requests (-v) off the terminal, they are still formatted
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t = time.time()
+        runs = []
+        for _ in range(args.runs):
+            results = []
+            if args.reenumerate:
+                results.append(reenumerate(sim, device,
+                    args.reenumerate == 'full'))
+            runs.append(results + runEnumeration(sim, device))
+        t = time.time() - t
+    finally:
+        sys.stdout = stdout
+
+    if args.record:
+        ser.close()
+    if args.metrics:
+        dump.stop()
+
+    summary = summarize(runs)
+
+    print '%-30s %8s %8s %8s %10s %10s' % ('request', 'rtrips', 'sent',
+            'recv', 'link [ms]', 'wall [ms]')
+    for name in sorted(summary):
+        s = summary[name]
+        print '%-30s %8.1f %8.1f %8.1f %10.3f %10.3f' % (name,
+                s['round_trips'], s['bytes_sent'], s['bytes_received'],
+                s['link_time'] * 1000, s['time'] * 1000)
+    print '%d enumerations in %.3f s' % (args.runs, t)
+    # the simulated link time bounds the rate on a real link
+    link = sum(s['link_time'] * s['count'] for s in summary.values())
+    print '%.1f enumerations/s (%.1f enumerations/s on the link)' % (
+            args.runs / t, args.runs / link)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp'   : time.time(),
+            'python'      : sys.version,
+            'baud'        : args.baud,
+            'delay'       : args.delay,
+            'verbose'     : args.verbose,
+            'shadow'      : args.shadow,
+            'firmware'    : args.firmware,
+            'runs'        : args.runs,
+            'total_time'  : t,
+            'requests'    : summary,
+            }, f, indent = 4, sort_keys = True)
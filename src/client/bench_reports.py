@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Benchmark of the sustained report throughput of the HID keyboard
+# (usb_hid_keyboard.py) against a simulated Teensy. The keyboard is enumerated
+# and configured, then a queue of reports is streamed on its interrupt IN
+# endpoint (see hid_stream.py) while control requests are still polled for.
+# Results are written as JSON.
+
+import argparse, json, sys, time
+
+from teensy_sim import *
+from tracing import WARNING
+import bench_enumeration
+from hid_text import compileText
+import usb_hid_keyboard as keyboard
+
+STATS = ['round_trips', 'bytes_sent', 'bytes_received', 'link_time']
+
+# alternating key press / release reports
+def reports(n):
+    for i in range(n):
+        if i % 2:
+            yield '\x00' * 8
+        else:
+            yield '\x00\x00' + chr(4 + (i / 2) % 26) + '\x00' * 5
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--reports', type = int, default = 1000,
+            help = 'number of reports streamed')
+    parser.add_argument('-b', '--baud', type = int, default = 1000000,
+            help = 'baud rate of the simulated link')
+    parser.add_argument('-d', '--delay', action = 'store_true',
+            help = 'sleep for the simulated link time')
+    parser.add_argument('-i', '--interval', type = float,
+            default = keyboard.REPORT_INTERVAL,
+            help = 'polling interval of the endpoint in ms')
+    parser.add_argument('-I', '--idle', type = int, default = 0,
+            help = 'idle rate set by the host (in units of 4 ms)')
+    parser.add_argument('-t', '--text',
+            help = 'stream the reports typing text instead')
+    parser.add_argument('-o', '--output', default = 'bench_reports.json',
+            help = 'JSON file to write the results to')
+    args = parser.parse_args()
+
+    keyboard.trace.setLevel(WARNING)
+
+    sim = SimulatedTeensy(args.baud, args.delay)
+    u = TeensyUSBProxy(sim, shadow = True)
+    u.init()
+    u.enable()
+    u.attach()
+
+    streamer = keyboard.ReportStreamer(u, keyboard.REPORT_EP,
+            keyboard.REPORT_SIZE, args.interval)
+    device = keyboard.HIDKeyboard(u, streamer)
+    bench_enumeration.runEnumeration(sim, device)
+    bench_enumeration.request(sim, device, keyboard.HID_INTERFACE_OUT,
+            keyboard.HID_REQUEST_CODE['SET_IDLE'], args.idle << 8, 0, 0)
+
+    if args.text is not None:
+        text = args.text.decode('utf-8')
+        queued = compileText(text)
+        args.reports = len(queued)
+    else:
+        queued = list(reports(args.reports))
+    streamer.extend(queued)
+
+    before = dict(sim.stats)
+    received = 0
+    t = time.time()
+    while streamer.pending():
+        device.poll()
+        streamer.service()
+        received += len(sim.takeIn(keyboard.REPORT_EP))
+    t = time.time() - t
+
+    stats = streamer.stats()
+    stats.update((k, sim.stats[k] - before[k]) for k in STATS)
+    stats['time'] = t
+    stats['received'] = received
+
+    print '%d reports in %.3f s (%d received by the host)' % (args.reports,
+            t, received)
+    print '%.1f reports/s, latency avg %.3f ms, max %.3f ms' % (
+            stats['reports_per_second'], stats['latency_avg'] * 1000,
+            stats['latency_max'] * 1000)
+    if args.text is not None:
+        print '%d characters in %d reports, %.1f characters/s' % (len(text),
+                args.reports, len(text) * stats['reports_per_second'] /
+                args.reports)
+    print '%.1f round-trips, %.1f bytes sent per report, link %.3f ms' % (
+            float(stats['round_trips']) / args.reports,
+            float(stats['bytes_sent']) / args.reports,
+            stats['link_time'] * 1000 / args.reports)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp' : time.time(),
+            'python'    : sys.version,
+            'baud'      : args.baud,
+            'delay'     : args.delay,
+            'interval'  : args.interval,
+            'idle'      : args.idle,
+            'reports'   : args.reports,
+            'text'      : args.text,
+            'results'   : stats,
+            }, f, indent = 4, sort_keys = True)
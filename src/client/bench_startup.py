@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# Benchmark of the client startup. Every run starts a fresh interpreter which
+# imports the HID keyboard (optionally together with the scapy layers), and
+# initializes and enumerates it against the simulated Teensy. The import
+# time, the time until the first enumeration is complete, and the lifetime of
+# the interpreter are reported. Results are written as JSON.
+
+import argparse, json, os, subprocess, sys, time
+
+# modules imported per scenario
+SCENARIOS = [
+        ('core',  ['usb_hid_keyboard']),
+        ('scapy', ['usb_hid_keyboard', 'usb_20', 'hid_11']),
+        ]
+
+# runs in the fresh interpreter, prints the timings as JSON
+def child(modules):
+    t = time.time()
+    for name in modules:
+        __import__(name)
+    imported = time.time()
+
+    from teensy_sim import SimulatedTeensy
+    from teensy_usb_proxy import TeensyUSBProxy
+    from tracing import WARNING
+    import bench_enumeration
+    import usb_hid_keyboard as keyboard
+
+    keyboard.trace.setLevel(WARNING)
+    sim = SimulatedTeensy()
+    u = TeensyUSBProxy(sim, shadow = True)
+    u.init()
+    u.enable()
+    u.attach()
+    bench_enumeration.runEnumeration(sim, keyboard.HIDKeyboard(u))
+
+    print json.dumps({
+        'import'      : imported - t,
+        'ready'       : time.time() - t,
+        'scapy'       : 'scapy' in sys.modules,
+        })
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def bench(modules, runs):
+    path = os.path.abspath(__file__)
+    results = []
+    for _ in range(runs):
+        t = time.time()
+        out = subprocess.check_output([sys.executable, path, '--child'] +
+                modules, cwd = os.path.dirname(path))
+        result = json.loads(out.splitlines()[-1])
+        result['process'] = time.time() - t
+        results.append(result)
+
+    return {
+            'modules' : modules,
+            'scapy'   : results[0]['scapy'],
+            'import'  : median([r['import'] for r in results]),
+            'ready'   : median([r['ready'] for r in results]),
+            'process' : median([r['process'] for r in results]),
+            'runs'    : results,
+            }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--runs', type = int, default = 5,
+            help = 'number of interpreters started per scenario')
+    parser.add_argument('-o', '--output', default = 'bench_startup.json',
+            help = 'JSON file to write the results to')
+    parser.add_argument('--child', nargs = '+', metavar = 'MODULE',
+            help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        sys.exit(0)
+
+    results = {}
+    print '%-8s %6s %12s %12s %12s' % ('', 'scapy', 'import [ms]',
+            'ready [ms]', 'process [ms]')
+    for name, modules in SCENARIOS:
+        result = bench(modules, args.runs)
+        results[name] = result
+        print '%-8s %6s %12.1f %12.1f %12.1f' % (name, result['scapy'],
+                result['import'] * 1000, result['ready'] * 1000,
+                result['process'] * 1000)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp' : time.time(),
+            'python'    : sys.version,
+            'runs'      : args.runs,
+            'results'   : results,
+            }, f, indent = 4, sort_keys = True)
@@ -0,0 +1,463 @@
+#!/usr/bin/python
+
+# Pool of Teensy boards driven by one worker process per serial port
+#
+# Every worker owns a TeensyUSBProxy and a USB device (the profile, e.g.,
+# usb_hid_keyboard.HIDKeyboard) and runs the jobs assigned to it: plain
+# enumerations or fuzz cases (ranges of mutants of descriptor_fuzz.py). As
+# the workers are processes, the boards do not contend for the GIL. The pool
+# assigns jobs to idle boards, collects the results and the per-board
+# throughput, and restarts workers that died or sent no heartbeat within the
+# timeout; their job is assigned again. Fuzz workers report every mutant
+# before serving it, hence the mutant a board hung on is known.
+#
+# Ports named sim://<name> are simulated boards (see teensy_sim.py), the
+# simulator acts as the host and enumerates the device. On real boards, the
+# host enumerates the device after it was attached.
+
+import argparse, json, multiprocessing, os, Queue, sys, time, traceback
+
+# prefix of simulated ports
+SIM_PREFIX = 'sim://'
+
+# seconds between heartbeats of a busy worker
+HEARTBEAT_INTERVAL = 0.5
+
+# events sent by the workers: (event, port, ...)
+READY     = 'ready'
+HEARTBEAT = 'heartbeat'
+SERVE     = 'serve'
+RESULT    = 'result'
+ERROR     = 'error'
+
+def simulated(port):
+    return port.startswith(SIM_PREFIX)
+
+# a simulated board that stops responding after the given number of writes
+# (to exercise the restart of workers)
+def stallingTeensy(after, baudrate, delay):
+    from teensy_sim import SimulatedTeensy
+
+    class StallingTeensy(SimulatedTeensy):
+        def write(self, data):
+            self.writes = getattr(self, 'writes', 0) + 1
+            return SimulatedTeensy.write(self, data)
+
+        def read(self, n = 1):
+            while self.writes >= after:
+                time.sleep(1)
+            return SimulatedTeensy.read(self, n)
+
+    return StallingTeensy(baudrate, delay)
+
+def openPort(port, options):
+    from teensy_sim import SimulatedTeensy
+    from teensy_usb_proxy import TeensyUSBProxy, BOOT_BAUDRATE
+
+    if simulated(port):
+        if options.get('stall'):
+            ser = stallingTeensy(options['stall'], BOOT_BAUDRATE,
+                    options['delay'])
+        else:
+            ser = SimulatedTeensy(BOOT_BAUDRATE, options['delay'])
+    else:
+        import serial
+        ser = serial.Serial(port, BOOT_BAUDRATE, timeout = None)
+
+    # the Teensy still runs at the rate of the worker restarted
+    u = TeensyUSBProxy(ser, options['shadow'])
+    if not u.resync(options['baudrate']):
+        raise IOError('switching %s to %d baud failed' % (port,
+            options['baudrate']))
+    return ser, u
+
+# returns the device class given as module.Class
+def profileClass(profile):
+    module, name = profile.rsplit('.', 1)
+    return getattr(__import__(module), name)
+
+class Worker:
+    def __init__(self, port, events, options):
+        from tracing import WARNING
+
+        self.port = port
+        self.events = events
+        self.options = options
+        self.ser, self.u = openPort(port, options)
+        self.sim = self.ser if simulated(port) else None
+        self.lastHeartbeat = 0
+
+        self.u.init()
+        self.u.enable()
+        self.u.attach()
+        self.device = profileClass(options['profile'])(self.u)
+        self.device.trace.setLevel(WARNING)
+        if options['firmware']:
+            self.device.upload()
+
+    def heartbeat(self):
+        now = time.time()
+        if now - self.lastHeartbeat >= HEARTBEAT_INTERVAL:
+            self.events.put((HEARTBEAT, self.port, now))
+            self.lastHeartbeat = now
+
+    # runs one enumeration, returns True if the device was configured
+    def enumerate(self):
+        self.device.reenumerate()
+        if self.sim is not None:
+            import bench_enumeration
+            bench_enumeration.runEnumeration(self.sim, self.device)
+        else:
+            deadline = time.time() + self.options['enumeration_timeout']
+            while not self.u.configuration and time.time() < deadline:
+                self.device.poll()
+        self.heartbeat()
+        return bool(self.u.configuration)
+
+    def runEnumerate(self, job):
+        configured = 0
+        for _ in range(job.get('count', 1)):
+            configured += self.enumerate()
+        return {'enumerations' : job.get('count', 1),
+                'configured'   : configured}
+
+    # enumerates the mutants [start, start + count) of a seed, returns the
+    # campaign log with the configuration outcome per enumeration
+    def runFuzz(self, job):
+        from descriptor_fuzz import DescriptorFuzzer, Campaign
+
+        fuzzer = DescriptorFuzzer(self.device.descriptors, job.get('seed', 0),
+                fixup = job.get('fixup', 0.5))
+        campaign = Campaign(self.device, fuzzer, job.get('start', 0),
+                job.get('count', 1), notify = lambda entry:
+                    self.events.put((SERVE, self.port, job['id'], entry)))
+        configured = []
+        try:
+            for _ in range(job.get('count', 1)):
+                campaign.serve()
+                configured.append(self.enumerate())
+        finally:
+            campaign.restore()
+        return {'enumerations' : len(configured),
+                'log'          : [entry[1:] + (ok,) for entry, ok in
+                    zip(campaign.log, configured)]}
+
+    def run(self, tasks):
+        self.events.put((READY, self.port, os.getpid()))
+        while True:
+            job = tasks.get()
+            if job is None:
+                break
+            t = time.time()
+            try:
+                f = getattr(self, 'run' + job['kind'].capitalize())
+                result = f(job)
+            except (IOError, OSError):
+                # the board (or its port) is gone, let the pool restart us
+                raise
+            except Exception:
+                self.events.put((ERROR, self.port, job['id'],
+                    traceback.format_exc()))
+                continue
+            self.events.put((RESULT, self.port, job['id'], result,
+                time.time() - t))
+
+def work(port, tasks, events, options):
+    Worker(port, events, options).run(tasks)
+
+class Board:
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+        self.tasks = None
+        self.job = None
+        self.ready = False
+        self.lastSeen = None
+        self.restarts = 0
+        # consecutive starts that did not become ready
+        self.failures = 0
+        self.failed = False
+        self.jobs = 0
+        self.enumerations = 0
+        self.busy = 0.0
+        # log entry of the mutant served last by the current job
+        self.served = None
+
+class BoardPool:
+    # profile is the USB device class run on the boards, a worker without
+    # heartbeat for timeout seconds is restarted, a job is tried on at most
+    # retries + 1 workers, a board whose worker failed to start failures
+    # times in a row is given up; the served mutants are logged to the file
+    # log (if any) as JSON lines
+    def __init__(self, ports, profile = 'usb_hid_keyboard.HIDKeyboard',
+            baudrate = 1000000, shadow = True, firmware = False,
+            delay = False, timeout = 10.0, retries = 2, failures = 3,
+            stall = None, log = None):
+        self.boards = [Board(port) for port in ports]
+        self.timeout = timeout
+        self.retries = retries
+        self.failures = failures
+        self.options = {
+                'profile'             : profile,
+                'baudrate'            : baudrate,
+                'shadow'              : shadow,
+                'firmware'            : firmware,
+                'delay'               : delay,
+                'enumeration_timeout' : timeout / 2,
+                }
+        # simulated ports stalling after a number of writes (first start
+        # only)
+        self.stall = stall or {}
+        self.events = multiprocessing.Queue()
+        self.pending = []
+        self.attempts = {}
+        self.results = {}
+        # job ID -> mutants served when a worker failed or hung
+        self.crashes = {}
+        self.log = log
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        for board in self.boards:
+            self.startWorker(board)
+
+    def startWorker(self, board):
+        options = dict(self.options)
+        if board.restarts == 0:
+            options['stall'] = self.stall.get(board.port)
+        board.tasks = multiprocessing.Queue()
+        board.process = multiprocessing.Process(target = work,
+                args = (board.port, board.tasks, self.events, options))
+        board.process.daemon = True
+        board.process.start()
+        board.ready = False
+        board.lastSeen = time.time()
+
+    def restart(self, board, reason):
+        sys.stderr.write('[-] restarting %s: %s\n' % (board.port, reason))
+        if board.process.is_alive():
+            board.process.terminate()
+        board.process.join()
+        if board.job is not None:
+            job, board.job = board.job, None
+            self.crashed(board, job['id'])
+            if self.attempts[job['id']] > self.retries:
+                self.results[job['id']] = {'error' : reason,
+                        'port' : board.port,
+                        'crashes' : self.crashes.get(job['id'], [])}
+            else:
+                self.pending.insert(0, job)
+        if not board.ready:
+            board.failures += 1
+            if board.failures >= self.failures:
+                sys.stderr.write('[-] giving up %s\n' % board.port)
+                board.failed = True
+                return
+        board.restarts += 1
+        self.startWorker(board)
+
+    # records the mutant served last by the job of a board
+    def crashed(self, board, job_id):
+        if board.served is not None:
+            self.crashes.setdefault(job_id, []).append(board.served[1])
+            board.served = None
+
+    def board(self, port):
+        for board in self.boards:
+            if board.port == port:
+                return board
+
+    def handle(self, event):
+        kind, port = event[:2]
+        board = self.board(port)
+        board.lastSeen = time.time()
+        if kind == READY:
+            board.ready = True
+            board.failures = 0
+        elif kind == SERVE:
+            job_id, entry = event[2:]
+            if board.job is None or board.job['id'] != job_id:
+                return
+            board.served = entry
+            if self.log is not None:
+                enumeration, index, key, ops = entry
+                self.log.write(json.dumps({
+                    'port'    : port,
+                    'job'     : job_id,
+                    'mutant'  : index,
+                    'seed'    : board.job.get('seed', 0),
+                    'key'     : key,
+                    'ops'     : ops,
+                    }) + '\n')
+                self.log.flush()
+        elif kind == RESULT:
+            job_id, result, t = event[2:]
+            if board.job is None or board.job['id'] != job_id:
+                return
+            result['port'] = port
+            result['time'] = t
+            if job_id in self.crashes:
+                result['crashes'] = self.crashes[job_id]
+            self.results[job_id] = result
+            board.job = None
+            board.served = None
+            board.jobs += 1
+            board.enumerations += result.get('enumerations', 0)
+            board.busy += t
+        elif kind == ERROR:
+            job_id, tb = event[2:]
+            self.crashed(board, job_id)
+            self.results[job_id] = {'error' : tb, 'port' : port,
+                    'crashes' : self.crashes.get(job_id, [])}
+            board.job = None
+
+    def assign(self):
+        for board in self.boards:
+            if board.ready and board.job is None and self.pending:
+                job = self.pending.pop(0)
+                self.attempts[job['id']] = self.attempts.get(job['id'], 0) + 1
+                board.job = job
+                board.lastSeen = time.time()
+                board.tasks.put(job)
+
+    def check(self):
+        now = time.time()
+        for board in self.boards:
+            if board.failed:
+                continue
+            if not board.process.is_alive():
+                self.restart(board, 'worker exited with %s' %
+                        board.process.exitcode)
+            elif (board.job is not None or not board.ready) and \
+                    now - board.lastSeen > self.timeout:
+                self.restart(board, 'no heartbeat for %.1f s' %
+                        (now - board.lastSeen))
+
+    # runs jobs (dicts with 'kind' and its parameters, an 'id' is added if
+    # missing), returns the results by job ID
+    def run(self, jobs):
+        if self.started is None:
+            self.start()
+        ids = []
+        for i, job in enumerate(jobs):
+            job = dict(job)
+            job.setdefault('id', i)
+            ids.append(job['id'])
+            self.pending.append(job)
+
+        while any(i not in self.results for i in ids):
+            self.assign()
+            try:
+                self.handle(self.events.get(timeout = HEARTBEAT_INTERVAL))
+                while True:
+                    self.handle(self.events.get_nowait())
+            except Queue.Empty:
+                pass
+            self.check()
+            if all(board.failed for board in self.boards):
+                raise IOError('no board left')
+        return dict((i, self.results[i]) for i in ids)
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        boards = {}
+        for board in self.boards:
+            boards[board.port] = {
+                    'jobs'                    : board.jobs,
+                    'enumerations'            : board.enumerations,
+                    'restarts'                : board.restarts,
+                    'busy'                    : board.busy,
+                    'enumerations_per_second' :
+                        board.enumerations / board.busy if board.busy else 0.0,
+                    }
+        enumerations = sum(b.enumerations for b in self.boards)
+        return {
+                'boards'                  : boards,
+                'elapsed'                 : elapsed,
+                'enumerations'            : enumerations,
+                'enumerations_per_second' : enumerations / elapsed,
+                }
+
+    def close(self):
+        for board in self.boards:
+            if board.process is not None and board.process.is_alive():
+                board.tasks.put(None)
+        for board in self.boards:
+            if board.process is not None:
+                board.process.join(1)
+                if board.process.is_alive():
+                    board.process.terminate()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-p', '--port', action = 'append', default = [],
+            help = 'serial port of a board (or sim://NAME)')
+    parser.add_argument('-b', '--boards', type = int, default = 0,
+            help = 'number of simulated boards to add')
+    parser.add_argument('-j', '--jobs', type = int, default = 16,
+            help = 'number of jobs')
+    parser.add_argument('-n', '--count', type = int, default = 50,
+            help = 'enumerations per job')
+    parser.add_argument('-z', '--fuzz', action = 'store_true',
+            help = 'serve mutated descriptors (one mutant per enumeration)')
+    parser.add_argument('-s', '--seed', type = int, default = 0,
+            help = 'seed of the mutants')
+    parser.add_argument('-o', '--output',
+            help = 'file to log the served mutants to')
+    parser.add_argument('-f', '--firmware', action = 'store_true',
+            help = 'answer standard requests from the descriptor store of '
+                   'the firmware')
+    parser.add_argument('-d', '--delay', action = 'store_true',
+            help = 'simulated boards sleep for the link time')
+    parser.add_argument('-t', '--timeout', type = float, default = 10.0,
+            help = 'restart workers without heartbeat for this many seconds')
+    parser.add_argument('--stall', type = int,
+            help = 'the first simulated board stops responding after this '
+                   'many writes')
+    args = parser.parse_args()
+
+    ports = args.port + ['%s%d' % (SIM_PREFIX, i) for i in range(args.boards)]
+    if not ports:
+        parser.error('no boards given')
+    stall = {}
+    if args.stall:
+        sims = [port for port in ports if simulated(port)]
+        if sims:
+            stall[sims[0]] = args.stall
+
+    jobs = []
+    for i in range(args.jobs):
+        if args.fuzz:
+            jobs.append({'kind' : 'fuzz', 'seed' : args.seed,
+                'start' : i * args.count, 'count' : args.count})
+        else:
+            jobs.append({'kind' : 'enumerate', 'count' : args.count})
+
+    log = open(args.output, 'w') if args.output else None
+    pool = BoardPool(ports, firmware = args.firmware, delay = args.delay,
+            timeout = args.timeout, stall = stall, log = log)
+    try:
+        results = pool.run(jobs)
+        stats = pool.stats()
+    finally:
+        pool.close()
+        if log is not None:
+            log.close()
+
+    errors = [r for r in results.values() if 'error' in r]
+    for r in errors:
+        print '[-] job on %s failed: %s' % (r['port'], r['error'])
+    for i, r in sorted(results.items()):
+        if r.get('crashes'):
+            print '[-] job %s stopped while serving mutants %s' % (i,
+                    ', '.join(map(str, r['crashes'])))
+
+    print '%-16s %6s %8s %8s %12s' % ('board', 'jobs', 'enums', 'restarts',
+            'enums/s')
+    for port, s in sorted(stats['boards'].items()):
+        print '%-16s %6d %8d %8d %12.1f' % (port, s['jobs'],
+                s['enumerations'], s['restarts'], s['enumerations_per_second'])
+    print '%d enumerations in %.3f s (%.1f enumerations/s)' % (
+            stats['enumerations'], stats['elapsed'],
+            stats['enumerations_per_second'])
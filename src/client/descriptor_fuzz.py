@@ -0,0 +1,439 @@
+#!/usr/bin/python
+
+# Mutation engine for fuzzing USB hosts with malformed descriptors
+#
+# DescriptorFuzzer derives mutants from the serialized DEVICE, CONFIGURATION,
+# HID and Report descriptors of a DescriptorTable. Standard descriptors are
+# split into their descriptors (by bLength) and mutated field by field (the
+# fields of the usb_20/hid_11 layers) or spliced (descriptors duplicated,
+# dropped, swapped, taken from other descriptors, truncated). Report
+# descriptors are mutated item by item. Length fields (bLength, wTotalLength,
+# bNumInterfaces, and wDescriptorLength of the HID descriptors) are fixed up
+# for a share of the mutants unless a mutation targeted them.
+#
+# Mutant i of a seed is always the same, i.e., a recorded mutant index
+# reproduces a crash. Campaign serves pre-serialized mutants through the
+# DescriptorTable of a USBDevice (a copy, the table may be shared by all
+# devices of a class) and records which mutant was served on each
+# enumeration, streamed to a log file before the mutant is served.
+
+import argparse, json, random, struct, time
+
+from usb_20_defs import *
+from hid_11_defs import *
+import hid_report
+
+# fields per descriptor type: (name, offset, size), names as in the scapy
+# layers of usb_20.py and hid_11.py
+HEADER = [('length', 0, 1), ('descriptor_type', 1, 1)]
+
+FIELDS = {
+        DESCRIPTOR_TYPE['DEVICE'] : HEADER + [
+            ('usb', 2, 2),
+            ('device_class', 4, 1),
+            ('device_subclass', 5, 1),
+            ('device_protocol', 6, 1),
+            ('max_packet_size_0', 7, 1),
+            ('id_vendor', 8, 2),
+            ('id_product', 10, 2),
+            ('device', 12, 2),
+            ('manufacturer', 14, 1),
+            ('product', 15, 1),
+            ('serial_number', 16, 1),
+            ('num_configurations', 17, 1),
+            ],
+        DESCRIPTOR_TYPE['CONFIGURATION'] : HEADER + [
+            ('total_length', 2, 2),
+            ('num_interfaces', 4, 1),
+            ('configuration_value', 5, 1),
+            ('configuration', 6, 1),
+            ('attributes', 7, 1),
+            ('max_power', 8, 1),
+            ],
+        DESCRIPTOR_TYPE['INTERFACE'] : HEADER + [
+            ('interface_number', 2, 1),
+            ('alternate_setting', 3, 1),
+            ('num_endpoints', 4, 1),
+            ('interface_class', 5, 1),
+            ('interface_subclass', 6, 1),
+            ('interface_protocol', 7, 1),
+            ('interface', 8, 1),
+            ],
+        DESCRIPTOR_TYPE['ENDPOINT'] : HEADER + [
+            ('endpoint_address', 2, 1),
+            ('attributes', 3, 1),
+            ('max_packet_size', 4, 2),
+            ('interval', 6, 1),
+            ],
+        DESCRIPTOR_TYPE['HID'] : HEADER + [
+            ('hid', 2, 2),
+            ('country_code', 4, 1),
+            ('num_descriptors', 5, 1),
+            ('descriptors.descriptor_type', 6, 1),
+            ('descriptors.descriptor_length', 7, 2),
+            ],
+        }
+
+# descriptor types mutated by default
+TARGETS = [DESCRIPTOR_TYPE['DEVICE'], DESCRIPTOR_TYPE['CONFIGURATION'],
+        DESCRIPTOR_TYPE['HID'], DESCRIPTOR_TYPE['Report']]
+
+# boundary values by field size
+INTERESTING = {
+        1 : [0x00, 0x01, 0x02, 0x7f, 0x80, 0xfe, 0xff],
+        2 : [0x0000, 0x0001, 0x00ff, 0x0100, 0x7fff, 0x8000, 0xfffe, 0xffff],
+        4 : [0x00000000, 0x00000001, 0x7fffffff, 0x80000000, 0xffffffff],
+        }
+
+FORMATS = {1 : '<B', 2 : '<H', 4 : '<I'}
+
+# item sizes by the size code of a short item prefix
+ITEM_SIZES = [0, 1, 2, 4]
+
+# splits serialized descriptors by bLength, a malformed rest is kept as one
+# unit
+def split(data):
+    units = []
+    i = 0
+    while i < len(data):
+        n = ord(data[i])
+        if n < 2 or i + n > len(data):
+            units.append(bytearray(data[i:]))
+            break
+        units.append(bytearray(data[i:i + n]))
+        i += n
+    return units
+
+# splits a report descriptor into its items (prefix and data)
+def splitItems(data):
+    units = []
+    i = 0
+    while i < len(data):
+        prefix = ord(data[i])
+        if prefix == hid_report.LONG_ITEM and i + 1 < len(data):
+            n = 3 + ord(data[i + 1])
+        else:
+            n = 1 + ITEM_SIZES[prefix & 0x03]
+        units.append(bytearray(data[i:i + n]))
+        i += n
+    return units
+
+class Mutant(object):
+    __slots__ = ['index', 'key', 'descriptors', 'ops']
+
+    def __init__(self, index, key, descriptors, ops):
+        self.index = index
+        # key of the mutated descriptor
+        self.key = key
+        # (descriptor type, index, language id) -> serialized descriptor,
+        # includes descriptors patched by the length fixups
+        self.descriptors = descriptors
+        # applied mutations as strings
+        self.ops = ops
+
+    def __repr__(self):
+        return '<Mutant %d %r %s>' % (self.index, self.key, ' '.join(self.ops))
+
+class DescriptorFuzzer:
+    # fixup is the share of mutants whose lengths are fixed up, ops the
+    # maximum number of mutations per mutant
+    def __init__(self, table, seed = 0, targets = TARGETS, fixup = 0.5,
+            ops = 4):
+        self.seed = seed
+        self.fixup = fixup
+        self.ops = ops
+
+        self.corpus = dict((key, desc.tobytes()) for key, desc in table.items())
+        self.keys = sorted(key for key in self.corpus if key[0] in targets)
+        if not self.keys:
+            raise ValueError('no descriptors to mutate')
+
+        # descriptors and items of the corpus for splices
+        self.units = []
+        self.items = []
+        for key, data in sorted(self.corpus.items()):
+            if key[0] == DESCRIPTOR_TYPE['Report']:
+                self.items.extend(splitItems(data))
+            elif key[0] != DESCRIPTOR_TYPE['STRING']:
+                self.units.extend(split(data))
+
+    def random(self, index):
+        return random.Random(self.seed * 0x100000001 + index)
+
+    # returns a value for a field of size bytes
+    def value(self, rng, size, old):
+        r = rng.random()
+        mask = (1 << (8 * size)) - 1
+        if r < 0.5:
+            return rng.choice(INTERESTING[size])
+        elif r < 0.7:
+            return (old + rng.choice([-2, -1, 1, 2])) & mask
+        elif r < 0.85:
+            return old ^ (1 << rng.randrange(8 * size))
+        return rng.randrange(mask + 1)
+
+    # splices units (descriptors or items) in place, pool are the units of
+    # the corpus and splitter splits serialized units, the first unit is kept
+    # unless truncating
+    def splice(self, rng, units, pool, splitter):
+        op = rng.choice(['duplicate', 'drop', 'swap', 'insert', 'truncate'])
+        i = rng.randrange(1, len(units)) if len(units) > 1 else 0
+        if op == 'duplicate':
+            units.insert(i, bytearray(units[i]))
+        elif op == 'drop' and len(units) > 1:
+            del units[i]
+        elif op == 'swap' and len(units) > 2:
+            j = rng.randrange(1, len(units))
+            units[i], units[j] = units[j], units[i]
+        elif op == 'insert' and pool:
+            units.insert(rng.randrange(1, len(units) + 1),
+                    bytearray(rng.choice(pool)))
+        elif op == 'truncate' and sum(map(len, units)) > 1:
+            data = ''.join(map(str, units))
+            i = rng.randrange(1, len(data))
+            units[:] = splitter(data[:i])
+        else:
+            return None
+        return '%s@%d' % (op, i)
+
+    # mutates a field of a standard descriptor, returns the op and the
+    # mutated (unit, field name)
+    def mutateField(self, rng, units):
+        i = rng.randrange(len(units))
+        unit = units[i]
+        fields = [f for f in FIELDS.get(unit[1] if len(unit) > 1 else None,
+            HEADER) if f[1] + f[2] <= len(unit)]
+        if not fields:
+            return None, None
+        name, offset, size = rng.choice(fields)
+        fmt = FORMATS[size]
+        old = struct.unpack_from(fmt, unit, offset)[0]
+        new = self.value(rng, size, old)
+        struct.pack_into(fmt, unit, offset, new)
+        return '%s[%d]=0x%x' % (name, i, new), (i, name)
+
+    # mutates the data or the prefix of a report descriptor item
+    def mutateItem(self, rng, units):
+        i = rng.randrange(len(units))
+        unit = units[i]
+        if rng.random() < 0.2:
+            # a random prefix, the following items are shifted
+            unit[0] = rng.randrange(256)
+            return 'prefix[%d]=0x%02x' % (i, unit[0])
+
+        # new data of a (possibly different) size, the prefix matches it
+        code = unit[0] & 0x03 if rng.random() < 0.7 else rng.randrange(1, 4)
+        size = ITEM_SIZES[code]
+        if not size:
+            return None
+        old = struct.unpack_from(FORMATS[size], str(unit[1:] + '\0' * 4))[0]
+        new = self.value(rng, size, old & ((1 << (8 * size)) - 1))
+        units[i] = bytearray(chr((unit[0] & 0xfc) | code)) + \
+                bytearray(struct.pack(FORMATS[size], new))
+        return 'item[%d]=0x%x' % (i, new)
+
+    # fixes up the lengths of standard descriptors except the mutated fields
+    # (unit, name) in keep
+    def fixLengths(self, units, keep, reportLength = None):
+        total = sum(map(len, units))
+        interfaces = len([u for u in units if len(u) > 1 and
+            u[1] == DESCRIPTOR_TYPE['INTERFACE']])
+        for i, unit in enumerate(units):
+            if (i, 'length') not in keep and len(unit) < 256:
+                unit[0] = len(unit)
+            if len(unit) < 2:
+                continue
+            if unit[1] == DESCRIPTOR_TYPE['CONFIGURATION'] and len(unit) >= 5:
+                if (i, 'total_length') not in keep:
+                    struct.pack_into('<H', unit, 2, total & 0xffff)
+                if (i, 'num_interfaces') not in keep:
+                    unit[4] = interfaces
+            elif unit[1] == DESCRIPTOR_TYPE['HID'] and len(unit) >= 9 and \
+                    reportLength is not None and unit[6] == \
+                    DESCRIPTOR_TYPE['Report'] and \
+                    (i, 'descriptors.descriptor_length') not in keep:
+                struct.pack_into('<H', unit, 7, reportLength)
+
+    # returns the mutant with the given index
+    def mutant(self, index):
+        rng = self.random(index)
+        key = rng.choice(self.keys)
+        data = self.corpus[key]
+        fixup = rng.random() < self.fixup
+        descriptors = {}
+        ops = []
+
+        if key[0] == DESCRIPTOR_TYPE['Report']:
+            units = splitItems(data)
+            for _ in range(rng.randint(1, self.ops)):
+                if rng.random() < 0.6:
+                    op = self.mutateItem(rng, units)
+                else:
+                    op = self.splice(rng, units, self.items, splitItems)
+                if op:
+                    ops.append(op)
+            data = ''.join(map(str, units))
+
+            # let the HID descriptors announce the new length
+            if fixup:
+                ops.append('fixup')
+                for k, desc in self.corpus.items():
+                    if k[0] in [DESCRIPTOR_TYPE['HID'],
+                            DESCRIPTOR_TYPE['CONFIGURATION']]:
+                        units = split(desc)
+                        self.fixLengths(units, (), len(data))
+                        descriptors[k] = ''.join(map(str, units))
+        else:
+            units = split(data)
+            keep = set()
+            for _ in range(rng.randint(1, self.ops)):
+                if rng.random() < 0.7:
+                    op, field = self.mutateField(rng, units)
+                    if field is not None:
+                        keep.add(field)
+                else:
+                    op = self.splice(rng, units, self.units, split)
+                if op:
+                    ops.append(op)
+            if fixup:
+                ops.append('fixup')
+                self.fixLengths(units, keep)
+            data = ''.join(map(str, units))
+
+        descriptors[key] = data
+        return Mutant(index, key, descriptors, ops)
+
+    # returns count mutants starting at index start
+    def generate(self, start, count):
+        return [self.mutant(i) for i in xrange(start, start + count)]
+
+class Campaign:
+    # device is a usb_device.USBDevice, mutants are generated in batches of
+    # batch mutants ahead of the enumerations, the served mutants are logged
+    # to the file out (if any) as JSON lines and passed to notify (if any)
+    def __init__(self, device, fuzzer, start = 0, batch = 1024, out = None,
+            notify = None):
+        self.device = device
+        device.descriptors = device.descriptors.copy()
+        self.fuzzer = fuzzer
+        self.out = out
+        self.notify = notify
+        self.next = start
+        self.batch = batch
+        self.mutants = []
+        self.original = {}
+        # per enumeration: (enumeration, mutant index, key, ops)
+        self.log = []
+        self.enumerations = 0
+
+    # restores the descriptors replaced by the last mutant
+    def restore(self):
+        table = self.device.descriptors
+        for key, desc in self.original.items():
+            table.add(key[0], key[1], key[2], desc)
+        self.original = {}
+
+    # serves the next mutant on the following enumeration, returns it
+    def serve(self):
+        if not self.mutants:
+            self.mutants = self.fuzzer.generate(self.next, self.batch)
+            self.mutants.reverse()
+        mutant = self.mutants.pop()
+        self.next = mutant.index + 1
+
+        # log the mutant before serving it, the host (or this process) may
+        # crash on it
+        self.enumerations += 1
+        entry = (self.enumerations, mutant.index, mutant.key, mutant.ops)
+        self.log.append(entry)
+        if self.out is not None:
+            self.write(self.out, entry)
+            self.out.flush()
+        if self.notify is not None:
+            self.notify(entry)
+
+        self.restore()
+        table = self.device.descriptors
+        for key, desc in mutant.descriptors.items():
+            self.original[key] = self.fuzzer.corpus[key]
+            table.add(key[0], key[1], key[2], desc)
+        if self.device.u.descriptorStore:
+            self.device.upload()
+        return mutant
+
+    def write(self, f, entry):
+        enumeration, index, key, ops = entry
+        f.write(json.dumps({
+            'enumeration' : enumeration,
+            'mutant'      : index,
+            'seed'        : self.fuzzer.seed,
+            'key'         : key,
+            'ops'         : ops,
+            }) + '\n')
+
+    # writes the log as JSON lines
+    def save(self, path):
+        with open(path, 'w') as f:
+            for entry in self.log:
+                self.write(f, entry)
+
+if __name__ == "__main__":
+    from teensy_sim import SimulatedTeensy
+    from teensy_usb_proxy import TeensyUSBProxy
+    from tracing import ERROR
+    import bench_enumeration
+    import usb_hid_keyboard as keyboard
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--runs', type = int, default = 1000,
+            help = 'number of enumerations')
+    parser.add_argument('-s', '--seed', type = int, default = 0,
+            help = 'seed of the mutants')
+    parser.add_argument('-i', '--start', type = int, default = 0,
+            help = 'index of the first mutant')
+    parser.add_argument('-x', '--fixup', type = float, default = 0.5,
+            help = 'share of mutants with fixed up lengths')
+    parser.add_argument('-f', '--firmware', action = 'store_true',
+            help = 'serve the mutants from the descriptor store of the '
+                   'firmware')
+    parser.add_argument('-p', '--print', action = 'store_true',
+            dest = 'show', help = 'print the mutants')
+    parser.add_argument('-o', '--output', required = True,
+            help = 'file to log the served mutants to')
+    args = parser.parse_args()
+
+    fuzzer = DescriptorFuzzer(keyboard.DESCRIPTOR_TABLE, args.seed,
+            fixup = args.fixup)
+
+    t = time.time()
+    mutants = fuzzer.generate(args.start, args.runs)
+    t = time.time() - t
+    print '%d mutants generated in %.3f s (%.0f mutants/s)' % (args.runs, t,
+            args.runs / t)
+    if args.show:
+        for mutant in mutants:
+            print mutant
+            for key, desc in sorted(mutant.descriptors.items()):
+                print '    %r %s' % (key, desc.encode('hex'))
+
+    sim = SimulatedTeensy()
+    u = TeensyUSBProxy(sim, shadow = True)
+    u.init()
+    u.enable()
+    u.attach()
+    keyboard.trace.setLevel(ERROR)
+    device = keyboard.HIDKeyboard(u)
+    if args.firmware:
+        device.upload()
+
+    campaign = Campaign(device, fuzzer, args.start,
+            out = open(args.output, 'w'))
+    t = time.time()
+    for _ in range(args.runs):
+        campaign.serve()
+        device.reenumerate()
+        bench_enumeration.runEnumeration(sim, device)
+    t = time.time() - t
+    campaign.out.close()
+    print '%d enumerations in %.3f s (%.1f enumerations/s)' % (args.runs, t,
+            args.runs / t)
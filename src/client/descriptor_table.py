@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+# Table of serialized descriptors
+#
+# Descriptors are serialized once and kept in a flat map keyed by
+# (descriptor type, descriptor index, language id). Responses truncated to the
+# wLength of a request are served as memoryview slices, i.e., without copying
+# the descriptor.
+
+class DescriptorTable:
+    # descriptors is a nested dict as used by usb_hid_keyboard.py:
+    # {descriptor type : {descriptor index : {language id : descriptor}}}
+    def __init__(self, descriptors = {}):
+        self.table = {}
+
+        for t, indices in descriptors.items():
+            for index, langids in indices.items():
+                for langid, desc in langids.items():
+                    self.add(t, index, langid, desc)
+
+    # desc can be a scapy packet or a string
+    def add(self, t, index, langid, desc):
+        self.table[(t, index, langid)] = memoryview(str(desc))
+
+    # returns a table of the same descriptors that can be changed separately
+    def copy(self):
+        table = DescriptorTable()
+        table.table = dict(self.table)
+        return table
+
+    def remove(self, t, index, langid):
+        del self.table[(t, index, langid)]
+
+    # returns the descriptor truncated to length bytes (or None if there is no
+    # such descriptor)
+    def get(self, t, index, langid, length = None):
+        desc = self.table.get((t, index, langid))
+        if desc is not None and length is not None and length < len(desc):
+            desc = desc[:length]
+        return desc
+
+    # returns the descriptor dissected by the scapy layers (which are only
+    # loaded here)
+    def dissect(self, t, index, langid):
+        from hid_11 import DESCRIPTOR_TYPE, Descriptor, ReportDescriptor
+        desc = self.table[(t, index, langid)].tobytes()
+        if t == DESCRIPTOR_TYPE['Report']:
+            return ReportDescriptor(desc)
+        return Descriptor(desc)
+
+    def items(self):
+        return self.table.items()
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def __len__(self):
+        return len(self.table)
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# Definitions for USB HID requests, codes and descriptors
+#
+# Like usb_20_defs.py, this module does not depend on scapy; the scapy layers
+# of hid_11.py dissect HID and report descriptors.
+
+import struct
+
+from usb_20_defs import *
+
+# USB Device Class Definition for HID, Version 1.11
+
+# Section 7.1. Standard Requests
+DESCRIPTOR_TYPE.update({
+        'HID'                 : 0x21,
+        'Report'              : 0x22,
+        'Physical Descriptor' : 0x23,
+        })
+
+# Section 7.2. Class-Specific Requests
+HID_REQUEST_CODE = {
+        'GET_REPORT'   : 0x01,
+        'GET_IDLE'     : 0x02,
+        'GET_PROTOCOL' : 0x03,
+        'SET_REPORT'   : 0x09,
+        'SET_IDLE'     : 0x0A,
+        'SET_PROTOCOL' : 0x0B,
+        }
+
+# Section 4.2. Subclass Codes
+SUBCLASS_CODE = {
+        'No Subclass' : 0x00,
+        'Boot'        : 0x01,
+        }
+
+# Section 4.3. Protocol Codes
+PROTOCOL_CODE = {
+        'None'     : 0x00,
+        'Keyboard' : 0x01,
+        'Mouse'    : 0x02,
+        }
+
+# Section 6.2.1. Country Code
+COUNTRY_CODE = {
+        'Not Supported'       : 0,
+        'Arabic'              : 1,
+        'Belgian'             : 2,
+        'Canadian-Bilingual'  : 3,
+        'Canadian-French'     : 4,
+        'Czech Republic'      : 5,
+        'Danish'              : 6,
+        'Finnish'             : 7,
+        'French'              : 8,
+        'German'              : 9,
+        'Greek'               : 10,
+        'Hebrew'              : 11,
+        'Hungary'             : 12,
+        'International (ISO)' : 13,
+        'Italian'             : 14,
+        'Japan (Katakana)'    : 15,
+        'Korean'              : 16,
+        'Latin American'      : 17,
+        'Netherlands/Dutch'   : 18,
+        'Norwegian'           : 19,
+        'Persian (Farsi)'     : 20,
+        'Poland'              : 21,
+        'Portuguese'          : 22,
+        'Russia'              : 23,
+        'Slovakia'            : 24,
+        'Spanish'             : 25,
+        'Swedish'             : 26,
+        'Swiss/French'        : 27,
+        'Swiss/German'        : 28,
+        'Switzerland'         : 29,
+        'Taiwan'              : 30,
+        'Turkish-Q'           : 31,
+        'UK'                  : 32,
+        'US'                  : 33,
+        'Yugoslavia'          : 34,
+        'Turkish-F'           : 35,
+        }
+
+# Section 6.2.1 HID Descriptor
+# descriptors are (descriptor type, length) of the class descriptors (e.g.,
+# the report descriptor)
+def hidDescriptor(descriptors, country_code = COUNTRY_CODE['Not Supported'],
+        hid = 0x0111):
+    return descriptor(DESCRIPTOR_TYPE['HID'],
+            struct.pack('<HBB', hid, country_code, len(descriptors)) +
+            ''.join(struct.pack('<BH', t, length)
+                for t, length in descriptors))
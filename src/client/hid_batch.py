@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# Vectorized encoding and decoding of HID reports with NumPy
+#
+# A BatchCodec is built from a compiled report (see hid_report.py). Values are
+# given as a matrix with one row per report and one column per field element
+# (in the order of Report.fields). All reports of a batch are converted at
+# once: the values are spread into a bit matrix (one column per report bit)
+# which is then folded into bytes, and vice versa. numpy.packbits() only
+# supports little-endian bit order since NumPy 1.17, hence the folding is done
+# with a dot product.
+
+import numpy
+
+BIT_WEIGHTS = 1 << numpy.arange(8, dtype = numpy.int64)
+
+class BatchCodec:
+    def __init__(self, report):
+        self.report = report
+        self.length = report.length
+
+        # per column (field element): bit offset, size, signedness
+        offsets, sizes, signed = [], [], []
+        for field in report.fields:
+            for i in range(field.count):
+                offsets.append(field.offset + i * field.size)
+                sizes.append(field.size)
+                signed.append(field.signed)
+        self.columns = len(offsets)
+        self.sizes = numpy.array(sizes, dtype = numpy.int64)
+        self.signed = numpy.array(signed, dtype = bool)
+
+        # per value bit: column, bit in the value and bit in the report
+        self.column = numpy.repeat(numpy.arange(self.columns), sizes)
+        starts = numpy.cumsum([0] + sizes[:-1])
+        self.bit = numpy.arange(len(self.column)) - \
+                numpy.repeat(starts, sizes).astype(numpy.int64)
+        self.position = numpy.repeat(offsets, sizes).astype(numpy.int64) + \
+                self.bit
+        self.starts = starts
+
+    # returns a uint8 matrix with one report per row, values is a matrix with
+    # one row per report and one column per field element
+    def encode(self, values):
+        values = numpy.asarray(values, dtype = numpy.int64)
+        if values.ndim == 1:
+            values = values.reshape(1, -1)
+        if values.shape[1] != self.columns:
+            raise ValueError('expected %d columns, got %d' % (self.columns,
+                values.shape[1]))
+
+        n = values.shape[0]
+        bits = numpy.zeros((n, self.length * 8), dtype = numpy.int64)
+        bits[:, self.position] = (values[:, self.column] >> self.bit) & 1
+        data = bits.reshape(n, self.length, 8).dot(BIT_WEIGHTS)
+        data = data.astype(numpy.uint8)
+        if self.report.report_id:
+            data[:, 0] = self.report.report_id
+        return data
+
+    # returns the reports as a list of strings
+    def encodeReports(self, values):
+        return [row.tobytes() for row in self.encode(values)]
+
+    # decodes a stream of reports (a string or a uint8 matrix), returns an
+    # int64 matrix with one row per report
+    def decode(self, data):
+        if isinstance(data, (str, buffer, memoryview)):
+            data = numpy.frombuffer(data, dtype = numpy.uint8)
+        data = numpy.asarray(data, dtype = numpy.uint8).reshape(-1,
+                self.length)
+
+        n = data.shape[0]
+        bits = (data[:, :, None].astype(numpy.int64) >> numpy.arange(8)) & 1
+        bits = bits.reshape(n, self.length * 8)
+        if not self.columns:
+            return numpy.zeros((n, 0), dtype = numpy.int64)
+        values = numpy.add.reduceat(bits[:, self.position] << self.bit,
+                self.starts, axis = 1)
+
+        # sign extension
+        sign = numpy.int64(1) << (self.sizes - 1)
+        negative = self.signed & ((values & sign) != 0)
+        values -= numpy.where(negative, sign << 1, 0)
+        return values
+
+    # splits a decoded matrix into a list of value lists per field (as
+    # returned by Report.decode())
+    def fields(self, values):
+        i = 0
+        result = []
+        for field in self.report.fields:
+            result.append(values[..., i:i + field.count])
+            i += field.count
+        return result
+
+# returns a BatchCodec per (kind, report ID) of a ReportLayout
+def codecs(layout):
+    return dict(((report.kind, report.report_id), BatchCodec(report))
+            for report in layout)
+
+# decodes captured reports of a layout with report IDs (e.g., the data stages
+# of SET_REPORT requests), returns the decoded values per report ID
+def decodeMixed(codecs, kind, reports):
+    groups = {}
+    for report in reports:
+        groups.setdefault(ord(report[0]), []).append(report)
+    return dict((report_id, codecs[(kind, report_id)].decode(''.join(group)))
+            for report_id, group in groups.items())
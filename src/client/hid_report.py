@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+# Compiled HID report descriptors
+#
+# USB Device Class Definition for HID, Version 1.11, Section 6.2.2
+#
+# parse() runs the item state machine of a report descriptor once (including
+# push/pop of the global state, long items and report IDs) and returns a
+# ReportLayout: for every report (kind and report ID), the fields with their
+# bit offset, size, count, logical range and usages. Reports can then be
+# encoded and decoded without looking at the descriptor again.
+
+# Section 6.2.2.2 Short Items
+TYPE_MAIN   = 0
+TYPE_GLOBAL = 1
+TYPE_LOCAL  = 2
+
+LONG_ITEM = 0xfe
+
+# Section 6.2.2.4 Main Items
+INPUT          = 0x8
+OUTPUT         = 0x9
+FEATURE        = 0xb
+COLLECTION     = 0xa
+END_COLLECTION = 0xc
+
+KIND_NAMES = {
+        INPUT   : 'Input',
+        OUTPUT  : 'Output',
+        FEATURE : 'Feature',
+        }
+
+# Section 6.2.2.5 Input, Output, and Feature Items (data bits)
+CONSTANT = 0x01
+VARIABLE = 0x02
+RELATIVE = 0x04
+
+# Section 6.2.2.6 Collection
+APPLICATION = 0x01
+
+# Section 6.2.2.7 Global Items
+USAGE_PAGE       = 0x0
+LOGICAL_MINIMUM  = 0x1
+LOGICAL_MAXIMUM  = 0x2
+PHYSICAL_MINIMUM = 0x3
+PHYSICAL_MAXIMUM = 0x4
+UNIT_EXPONENT    = 0x5
+UNIT             = 0x6
+REPORT_SIZE      = 0x7
+REPORT_ID        = 0x8
+REPORT_COUNT     = 0x9
+PUSH             = 0xa
+POP              = 0xb
+
+# Section 6.2.2.8 Local Items
+USAGE         = 0x0
+USAGE_MINIMUM = 0x1
+USAGE_MAXIMUM = 0x2
+
+# global items with signed data
+SIGNED_ITEMS = [LOGICAL_MINIMUM, LOGICAL_MAXIMUM, PHYSICAL_MINIMUM,
+        PHYSICAL_MAXIMUM, UNIT_EXPONENT]
+
+class ReportField(object):
+    __slots__ = ['kind', 'report_id', 'offset', 'size', 'count', 'flags',
+            'logical_minimum', 'logical_maximum', 'usage_page', 'usages',
+            'application']
+
+    def __init__(self, kind, report_id, offset, size, count, flags, state,
+            usages, application):
+        self.kind = kind
+        self.report_id = report_id
+        # bit offset in the report (including the report ID byte)
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.flags = flags
+        self.logical_minimum, self.logical_maximum = \
+                signedRange(state[LOGICAL_MINIMUM], state[LOGICAL_MAXIMUM])
+        self.usage_page = state[USAGE_PAGE]
+        # extended usages (usage page << 16 | usage); for variable fields one
+        # per element, for array fields the usages selectable by the values
+        self.usages = usages
+        # usage of the application collection the field belongs to
+        self.application = application
+
+    @property
+    def constant(self):
+        return (self.flags & CONSTANT) != 0
+
+    @property
+    def variable(self):
+        return (self.flags & VARIABLE) != 0
+
+    @property
+    def signed(self):
+        return self.logical_minimum < 0
+
+    def __repr__(self):
+        return '<ReportField %s id=%d offset=%d size=%d count=%d ' \
+                'logical=[%d, %d] usages=%s>' % (
+                        KIND_NAMES[self.kind], self.report_id, self.offset,
+                        self.size, self.count, self.logical_minimum,
+                        self.logical_maximum, ' '.join('%08x' % usage
+                            for usage in self.usages[:8]) +
+                        (' ...' if len(self.usages) > 8 else ''))
+
+class Report:
+    def __init__(self, kind, report_id):
+        self.kind = kind
+        self.report_id = report_id
+        self.fields = []
+        # size in bits (including the report ID byte)
+        self.bits = 8 if report_id else 0
+
+    # size in bytes
+    @property
+    def length(self):
+        return (self.bits + 7) / 8
+
+    # decodes a report, returns a list of values per field
+    def decode(self, data):
+        v = long(str(data)[::-1].encode('hex') or '0', 16)
+        values = []
+        for field in self.fields:
+            mask = (1 << field.size) - 1
+            sign = 1 << (field.size - 1)
+            vals = []
+            for i in range(field.count):
+                x = (v >> (field.offset + i * field.size)) & mask
+                if field.signed and x & sign:
+                    x -= 1 << field.size
+                vals.append(int(x))
+            values.append(vals)
+        return values
+
+    # encodes a report from a list of values per field (as returned by
+    # decode()), missing values are 0
+    def encode(self, values):
+        v = self.report_id
+        for field, vals in zip(self.fields, values):
+            mask = (1 << field.size) - 1
+            for i, x in enumerate(vals[:field.count]):
+                v |= (x & mask) << (field.offset + i * field.size)
+        return ('%0*x' % (self.length * 2, v)).decode('hex')[::-1]
+
+class ReportLayout:
+    def __init__(self):
+        # (kind, report ID) -> Report
+        self.reports = {}
+
+    def report(self, kind, report_id = 0):
+        return self.reports[(kind, report_id)]
+
+    def __iter__(self):
+        return iter(sorted(self.reports.values(),
+            key = lambda r: (r.kind, r.report_id)))
+
+    def __len__(self):
+        return len(self.reports)
+
+    def addField(self, kind, report_id, size, count, flags, state, usages,
+            application):
+        key = (kind, report_id)
+        if key not in self.reports:
+            self.reports[key] = Report(kind, report_id)
+        report = self.reports[key]
+        field = ReportField(kind, report_id, report.bits, size, count, flags,
+                state, usages, application)
+        report.fields.append(field)
+        report.bits += size * count
+        return field
+
+# returns the data of an item as unsigned integer
+def unsigned(data):
+    v = 0
+    for i, c in enumerate(data):
+        v |= ord(c) << (8 * i)
+    return v
+
+def signed(data):
+    v = unsigned(data)
+    if data and v & (1 << (8 * len(data) - 1)):
+        v -= 1 << (8 * len(data))
+    return v
+
+# returns the range given by the data of a minimum and a maximum item, a
+# positive maximum might have been encoded without sign (e.g., 0xff with a
+# minimum of 0)
+def signedRange(minimum, maximum):
+    lo = signed(minimum)
+    hi = signed(maximum)
+    if lo >= 0 and hi < 0:
+        hi = unsigned(maximum)
+    return lo, hi
+
+# returns the items of a report descriptor as (type, tag, data), long items
+# are skipped
+def items(desc):
+    desc = str(desc)
+    i = 0
+    while i < len(desc):
+        prefix = ord(desc[i])
+        if prefix == LONG_ITEM:
+            if i + 1 >= len(desc):
+                raise ValueError('truncated long item at %d' % i)
+            i += 3 + ord(desc[i + 1])
+            continue
+
+        size = [0, 1, 2, 4][prefix & 0x03]
+        if i + 1 + size > len(desc):
+            raise ValueError('truncated item at %d' % i)
+        yield (prefix >> 2) & 0x03, prefix >> 4, desc[i + 1:i + 1 + size]
+        i += 1 + size
+
+# compiles a report descriptor (a string or a hid_11.ReportDescriptor)
+def parse(desc):
+    layout = ReportLayout()
+
+    # items with signed data are kept as data until their range is known
+    state = {
+            USAGE_PAGE       : 0,
+            LOGICAL_MINIMUM  : '',
+            LOGICAL_MAXIMUM  : '',
+            PHYSICAL_MINIMUM : '',
+            PHYSICAL_MAXIMUM : '',
+            UNIT_EXPONENT    : '',
+            UNIT             : 0,
+            REPORT_SIZE      : 0,
+            REPORT_ID        : 0,
+            REPORT_COUNT     : 0,
+            }
+    stack = []
+
+    usages = []
+    usageMinimum = None
+
+    collections = []
+    application = None
+
+    for t, tag, data in items(desc):
+        if t == TYPE_MAIN:
+            if tag in KIND_NAMES:
+                flags = unsigned(data)
+                count = state[REPORT_COUNT]
+                if flags & VARIABLE:
+                    # the last usage applies to the remaining elements
+                    if usages:
+                        usages = (usages + usages[-1:] * count)[:count]
+                layout.addField(tag, state[REPORT_ID], state[REPORT_SIZE],
+                        count, flags, state, usages, application)
+            elif tag == COLLECTION:
+                collections.append(usages[0] if usages else None)
+                if unsigned(data) == APPLICATION and application is None:
+                    application = collections[-1]
+            elif tag == END_COLLECTION:
+                if not collections:
+                    raise ValueError('End Collection without Collection')
+                collections.pop()
+                if not collections:
+                    application = None
+
+            # local items only apply to the next main item
+            usages = []
+            usageMinimum = None
+
+        elif t == TYPE_GLOBAL:
+            if tag == PUSH:
+                stack.append(dict(state))
+            elif tag == POP:
+                if not stack:
+                    raise ValueError('Pop without Push')
+                state = stack.pop()
+            elif tag in SIGNED_ITEMS:
+                state[tag] = data
+            elif tag in state:
+                state[tag] = unsigned(data)
+
+        elif t == TYPE_LOCAL:
+            # usages of up to 2 bytes refer to the current usage page
+            usage = unsigned(data)
+            if len(data) <= 2:
+                usage |= state[USAGE_PAGE] << 16
+            if tag == USAGE:
+                usages.append(usage)
+            elif tag == USAGE_MINIMUM:
+                usageMinimum = usage
+            elif tag == USAGE_MAXIMUM and usageMinimum is not None:
+                usages.extend(range(usageMinimum, usage + 1))
+                usageMinimum = None
+
+    if collections:
+        raise ValueError('Collection without End Collection')
+    return layout
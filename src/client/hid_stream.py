@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# Streaming of HID input reports on an interrupt IN endpoint
+#
+# Reports are queued by the device logic and written to the endpoint whenever
+# its bank is free (TXINI), but not faster than the polling interval of the
+# endpoint descriptor. If the host set an idle rate (SET_IDLE), the last
+# report is repeated when no new report was sent for the idle duration.
+
+import collections, time
+
+from teensy_usb_proxy import *
+
+# USB Device Class Definition for HID, Version 1.11
+# Section 7.2.4. Set_Idle Request: the duration is given in units of 4 ms
+IDLE_UNIT = 0.004
+
+# releases the IN bank: clears TXINI, RXOUTI, NAKINI and FIFOCON
+UEINTX_SEND = 0x3A
+
+class ReportStreamer:
+    # interval is the bInterval of the endpoint descriptor (in ms, i.e.,
+    # frames at full speed)
+    def __init__(self, u, ep = 3, size = 8, interval = 1, clock = time.time):
+        self.u = u
+        self.ep = ep
+        self.size = size
+        self.interval = interval / 1000.0
+        self.clock = clock
+
+        # (report, time queued)
+        self.queue = collections.deque()
+
+        # idle duration in seconds (0: report only when data changes)
+        self.idle = 0
+        self.last = None
+        self.lastTime = None
+
+        self.resetStats()
+
+    # drops the queued reports and the idle rate (e.g., when the device is
+    # enumerated again)
+    def reset(self):
+        self.queue.clear()
+        self.idle = 0
+        self.last = None
+        self.lastTime = None
+
+    def resetStats(self):
+        self.reports = 0
+        self.repeats = 0
+        self.busy = 0
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+        self.started = None
+
+    def put(self, report):
+        if len(report) > self.size:
+            raise ValueError('report exceeds %d bytes' % self.size)
+        self.queue.append((report, self.clock()))
+
+    def extend(self, reports):
+        for report in reports:
+            self.put(report)
+
+    def pending(self):
+        return len(self.queue)
+
+    # duration is the upper byte of wValue of SET_IDLE (in units of 4 ms)
+    def setIdle(self, duration):
+        self.idle = duration * IDLE_UNIT
+
+    def getIdle(self):
+        return int(round(self.idle / IDLE_UNIT))
+
+    # returns the report due at time now (and whether it is a repetition)
+    def due(self, now):
+        if self.lastTime is not None and now - self.lastTime < self.interval:
+            return None, False
+        if self.queue:
+            return self.queue[0][0], False
+        if self.idle and self.last is not None and \
+                now - self.lastTime >= self.idle:
+            return self.last, True
+        return None, False
+
+    # sends the next due report if the bank of the endpoint is free, returns
+    # True if a report was sent
+    def service(self):
+        if not self.u.configuration:
+            return False
+
+        now = self.clock()
+        report, repeat = self.due(now)
+        if report is None:
+            return False
+
+        with self.u.transaction() as tx:
+            self.u.write('UENUM', self.ep)
+            i = tx.read('UEINTX')
+            self.u.write('UENUM', 0)
+        if not ord(tx.results[i]) & (1 << TXINI):
+            self.busy += 1
+            return False
+
+        with self.u.transaction():
+            self.u.write('UENUM', self.ep)
+            if report:
+                self.u.write('UEDATX', report)
+            self.u.write('UEINTX', UEINTX_SEND)
+            self.u.write('UENUM', 0)
+
+        now = self.clock()
+        if repeat:
+            self.repeats += 1
+        else:
+            queued = self.queue.popleft()[1]
+            latency = now - queued
+            self.reports += 1
+            self.latencyTotal += latency
+            self.latencyMax = max(self.latencyMax, latency)
+        if self.started is None:
+            self.started = now
+        self.last = report
+        self.lastTime = now
+        return True
+
+    # sends all queued reports
+    def drain(self):
+        while self.queue:
+            if not self.service():
+                time.sleep(self.interval / 4)
+
+    def stats(self):
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = self.lastTime - self.started
+        return {
+                'reports'            : self.reports,
+                'repeats'            : self.repeats,
+                'busy'               : self.busy,
+                'queued'             : len(self.queue),
+                'reports_per_second' : (self.reports + self.repeats - 1) /
+                                           elapsed if elapsed else 0.0,
+                'latency_avg'        : self.latencyTotal / self.reports
+                                           if self.reports else 0.0,
+                'latency_max'        : self.latencyMax,
+                }
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# Compiles text to boot keyboard input reports (see usb_hid_keyboard.py)
+#
+# Each report presses up to six distinct keys with the same modifiers; the
+# host reports new keys in the order of the key array. A key still pressed in
+# the previous report does not register again, hence a release report is only
+# inserted before a report that starts with such a key. The most recently
+# compiled texts are cached.
+
+import collections
+
+from hid_11_defs import COUNTRY_CODE
+
+# USB HID Usage Tables, Section 10. Keyboard/Keypad Page
+MOD_LCTRL  = 0x01
+MOD_LSHIFT = 0x02
+MOD_LALT   = 0x04
+MOD_LGUI   = 0x08
+MOD_RCTRL  = 0x10
+MOD_RSHIFT = 0x20
+MOD_RALT   = 0x40
+MOD_RGUI   = 0x80
+
+# modifiers of the characters of a key: plain, shifted, AltGr
+LEVELS = [0, MOD_LSHIFT, MOD_RALT]
+
+MAX_KEYS = 6
+
+RELEASE = '\x00' * 8
+
+# returns a dict mapping characters to (modifiers, usage)
+# ranges are (first usage, strings of characters per level) with '\0' for
+# keys without a character
+def keymap(*ranges):
+    keys = {}
+    for usage, levels in ranges:
+        for mod, chars in zip(LEVELS, levels):
+            for i, c in enumerate(chars):
+                if c != u'\0' and c not in keys:
+                    keys[c] = (mod, usage + i)
+    return keys
+
+# Enter, Escape, Backspace, Tab, Space
+CONTROL_KEYS = (0x28, (u'\n\x1b\b\t ',))
+
+US_LAYOUT = keymap(
+        (0x04, (u'abcdefghijklmnopqrstuvwxyz', u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')),
+        (0x1e, (u'1234567890', u'!@#$%^&*()')),
+        CONTROL_KEYS,
+        (0x2d, (u'-=[]\\\0;\'`,./', u'_+{}|\0:"~<>?')),
+        )
+
+# dead keys (acute and circumflex accents) are left out
+GERMAN_LAYOUT = keymap(
+        (0x04, (u'abcdefghijklmnopqrstuvwxzy', u'ABCDEFGHIJKLMNOPQRSTUVWXZY',
+            u'\0\0\0\0\u20ac\0\0\0\0\0\0\0\xb5\0\0\0@')),
+        (0x1e, (u'1234567890', u'!"\xa7$%&/()=', u'\0\xb2\xb3\0\0\0{[]}')),
+        CONTROL_KEYS,
+        (0x2d, (u'\xdf\0\xfc+\0#\xf6\xe4\0,.-', u'?\0\xdc*\0\'\xd6\xc4\xb0;:_',
+            u'\\\0\0~')),
+        (0x64, (u'<', u'>', u'|')),
+        )
+
+# layouts by country code of the HID descriptor
+LAYOUTS = {
+        COUNTRY_CODE['Not Supported'] : US_LAYOUT,
+        COUNTRY_CODE['German']        : GERMAN_LAYOUT,
+        COUNTRY_CODE['US']            : US_LAYOUT,
+        }
+
+# compiled texts by (text, country code), least recently used first
+CACHE = collections.OrderedDict()
+CACHE_SIZE = 64
+
+def report(mod, keys):
+    return chr(mod) + '\x00' + ''.join(map(chr, keys)) + \
+            '\x00' * (MAX_KEYS - len(keys))
+
+# returns the reports typing text (a unicode string), the last report
+# releases all keys
+def compileText(text, country = COUNTRY_CODE['US']):
+    key = (text, country)
+    if key in CACHE:
+        reports = CACHE.pop(key)
+        CACHE[key] = reports
+        return reports
+
+    layout = LAYOUTS[country]
+    reports = []
+    previous = []
+    mod, pressed = 0, []
+    for c in text:
+        try:
+            m, k = layout[c]
+        except KeyError:
+            raise ValueError('character %r not in layout %d' % (c, country))
+
+        if pressed and (m != mod or k in pressed or k in previous or
+                len(pressed) == MAX_KEYS):
+            reports.append(report(mod, pressed))
+            previous, pressed = pressed, []
+
+        if not pressed:
+            if k in previous:
+                reports.append(RELEASE)
+                previous = []
+            mod = m
+        pressed.append(k)
+
+    if pressed:
+        reports.append(report(mod, pressed))
+        reports.append(RELEASE)
+
+    reports = tuple(reports)
+    CACHE[key] = reports
+    if len(CACHE) > CACHE_SIZE:
+        CACHE.popitem(last = False)
+    return reports
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+# Record and replay of the serial link traffic
+#
+# RecordingSerial wraps a serial port (or a SimulatedTeensy) and logs every
+# write and read with a timestamp. A trace starts with a header (magic and
+# start time) followed by records, each a header (time since the start in ns,
+# direction, length) and the data. TraceReader maps a trace into memory and
+# iterates over its records without copying the data. ReplaySerial plays a
+# trace back as a serial port, either as fast as possible (to profile the
+# client) or with the original timing.
+
+import argparse, mmap, struct, time
+
+MAGIC = 'TUPTRC01'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<QBI')
+
+# directions
+WRITE = 0
+READ  = 1
+
+def now():
+    return int(time.time() * 1e9)
+
+class RecordingSerial(object):
+    def __init__(self, ser, f):
+        self.ser = ser
+        self.f = f
+        self.start = now()
+        f.write(HEADER.pack(MAGIC, self.start))
+
+    def record(self, direction, data):
+        self.f.write(RECORD.pack(now() - self.start, direction, len(data)))
+        self.f.write(data)
+
+    # set by TeensyUSBProxy.set_baud() and resync()
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.ser.baudrate = baudrate
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ser.timeout = timeout
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.record(WRITE, data)
+        return self.ser.write(data)
+
+    def read(self, n = 1):
+        data = self.ser.read(n)
+        self.record(READ, data)
+        return data
+
+    def inWaiting(self):
+        return self.ser.inWaiting()
+
+    def send_break(self, duration = 0.25):
+        self.ser.send_break(duration)
+
+    def flushInput(self):
+        self.ser.flushInput()
+
+    def flushOutput(self):
+        self.ser.flushOutput()
+
+    def close(self):
+        self.ser.close()
+        self.f.close()
+
+class TraceReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, self.start = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a link trace' % path)
+
+    # yields (time since the start in ns, direction, data) per record, the
+    # data is a buffer referring to the mapped trace
+    def __iter__(self):
+        i = HEADER.size
+        end = len(self.map)
+        while i + RECORD.size <= end:
+            t, direction, n = RECORD.unpack_from(self.map, i)
+            i += RECORD.size
+            yield t, direction, buffer(self.map, i, n)
+            i += n
+
+    def summary(self):
+        s = {
+                'records'       : 0,
+                'writes'        : 0,
+                'reads'         : 0,
+                'bytes_written' : 0,
+                'bytes_read'    : 0,
+                'duration'      : 0.0,
+                }
+        for t, direction, data in self:
+            s['records'] += 1
+            if direction == WRITE:
+                s['writes'] += 1
+                s['bytes_written'] += len(data)
+            else:
+                s['reads'] += 1
+                s['bytes_read'] += len(data)
+            s['duration'] = t / 1e9
+        return s
+
+    def close(self):
+        self.map.close()
+
+class ReplaySerial(object):
+    # with realtime, reads return when the recorded read did, with strict,
+    # writes differing from the recorded ones raise a ValueError
+    def __init__(self, reader, realtime = False, strict = True):
+        self.records = list(reader)
+        self.realtime = realtime
+        self.strict = strict
+        self.i = 0
+        self.pending = ''
+        self.start = None
+        self.baudrate = None
+        self.timeout = None
+
+    def nextRecord(self, direction):
+        while self.i < len(self.records):
+            record = self.records[self.i]
+            self.i += 1
+            if record[1] == direction:
+                return record
+        raise EOFError('end of trace')
+
+    def wait(self, t):
+        if self.start is None:
+            self.start = time.time() - t / 1e9
+        elif self.realtime:
+            delay = self.start + t / 1e9 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        t, direction, recorded = self.nextRecord(WRITE)
+        self.wait(t)
+        if self.strict and str(recorded) != data:
+            raise ValueError('write %d differs from the trace' % (self.i - 1))
+        self.pending = ''
+        return len(data)
+
+    def read(self, n = 1):
+        if self.i < len(self.records) and self.records[self.i][1] == READ:
+            t, direction, data = self.records[self.i]
+            self.i += 1
+            self.wait(t)
+            self.pending += str(data)
+        elif not self.pending:
+            raise EOFError('end of trace')
+        data, self.pending = self.pending[:n], self.pending[n:]
+        return data
+
+    def inWaiting(self):
+        return len(self.pending)
+
+    def send_break(self, duration = 0.25):
+        pass
+
+    def flushInput(self):
+        self.pending = ''
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+def show(args):
+    reader = TraceReader(args.trace)
+    for t, direction, data in reader:
+        print '%12.6f %s %4d %s' % (t / 1e9, '>' if direction == WRITE else '<',
+                len(data), str(data[:32]).encode('hex'))
+    for k, v in sorted(reader.summary().items()):
+        print '%s: %s' % (k, v)
+
+# replays a trace recorded by bench_enumeration.py -r (with the same options)
+def replay(args):
+    from teensy_usb_proxy import TeensyUSBProxy
+    from tracing import WARNING
+    import usb_hid_keyboard as keyboard
+
+    keyboard.trace.setLevel(WARNING)
+    reader = TraceReader(args.trace)
+    ser = ReplaySerial(reader, args.realtime)
+    u = TeensyUSBProxy(ser, args.shadow)
+
+    t = time.time()
+    polls = 0
+    try:
+        u.init()
+        u.enable()
+        u.attach()
+        device = keyboard.HIDKeyboard(u)
+        if args.firmware:
+            device.upload()
+        while True:
+            device.poll()
+            polls += 1
+    except EOFError:
+        pass
+    t = time.time() - t
+
+    print '%d polls replayed in %.3f s (trace: %.3f s)' % (polls, t,
+            reader.summary()['duration'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('show', help = 'print the records of a trace')
+    p.add_argument('trace')
+    p.set_defaults(func = show)
+
+    p = subparsers.add_parser('replay',
+            help = 'replay a trace against the HID keyboard')
+    p.add_argument('trace')
+    p.add_argument('-t', '--realtime', action = 'store_true',
+            help = 'replay with the original timing')
+    p.add_argument('-s', '--shadow', action = 'store_true',
+            help = 'enable the shadow registers of the proxy')
+    p.add_argument('-f', '--firmware', action = 'store_true',
+            help = 'upload the descriptors to the firmware')
+    p.set_defaults(func = replay)
+
+    args = parser.parse_args()
+    args.func(args)
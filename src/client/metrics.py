@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+# Metrics of the serial link
+#
+# TeensyUSBProxy counts the register accesses (by register and kind), the
+# bytes sent and received and the round-trips, and keeps latency histograms
+# of the round-trips, read() and waitForInterrupt(). USBDevice adds the count
+# and latency of the handled requests by request type. Updating the metrics
+# costs a few dict and list increments per access, hence they are always on.
+# snapshot() returns all metrics as a dict, PeriodicDump writes snapshots as
+# JSON lines.
+
+import collections, json, threading, time
+
+# histogram bucket i counts latencies below 2^i us (and at least 2^(i-1) us)
+BUCKETS = 32
+
+class Histogram(object):
+    __slots__ = ['buckets', 'count', 'total', 'max']
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # t is the latency in seconds
+    def add(self, t):
+        self.buckets[min(int(t * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    # returns the upper bound of the bucket holding the given quantile (in
+    # seconds)
+    def quantile(self, q):
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= q * self.count and c:
+                return (1 << i) / 1e6
+        return 0.0
+
+    def snapshot(self):
+        return {
+                'count'   : self.count,
+                'total'   : self.total,
+                'mean'    : self.total / self.count if self.count else 0.0,
+                'max'     : self.max,
+                'p50'     : self.quantile(0.5),
+                'p99'     : self.quantile(0.99),
+                # upper bound in us -> count
+                'buckets' : dict((1 << i, c)
+                    for i, c in enumerate(self.buckets) if c),
+                }
+
+class Metrics:
+    def __init__(self, clock = time.time):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        # register -> number of accesses
+        self.reads = collections.defaultdict(int)
+        self.writes = collections.defaultdict(int)
+        self.polls = collections.defaultdict(int)
+        self.modifies = collections.defaultdict(int)
+        # writes skipped because of the shadow registers
+        self.skipped = collections.defaultdict(int)
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.round_trips = 0
+        self.latency = {
+                'round_trip'       : Histogram(),
+                'read'             : Histogram(),
+                'waitForInterrupt' : Histogram(),
+                }
+
+        # request name -> latency of the handler
+        self.requests = collections.defaultdict(Histogram)
+        self.started = self.clock()
+
+    # a serial buffer sent without waiting for a response
+    def sent(self, n):
+        self.bytes_sent += n
+
+    # a serial buffer sent and the response received after t seconds
+    def roundTrip(self, sent, received, t):
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.round_trips += 1
+        self.latency['round_trip'].add(t)
+
+    def request(self, name, t):
+        self.requests[name].add(t)
+
+    def snapshot(self):
+        now = self.clock()
+        return {
+                'time'           : now,
+                'elapsed'        : now - self.started,
+                'reads'          : dict(self.reads),
+                'writes'         : dict(self.writes),
+                'polls'          : dict(self.polls),
+                'modifies'       : dict(self.modifies),
+                'skipped'        : dict(self.skipped),
+                'bytes_sent'     : self.bytes_sent,
+                'bytes_received' : self.bytes_received,
+                'round_trips'    : self.round_trips,
+                'latency'        : dict((k, h.snapshot())
+                    for k, h in self.latency.items()),
+                'requests'       : dict((k, h.snapshot())
+                    for k, h in self.requests.items()),
+                }
+
+    # writes a snapshot as a JSON line
+    def dump(self, f):
+        f.write(json.dumps(self.snapshot(), sort_keys = True) + '\n')
+        f.flush()
+
+# dumps the metrics to f every interval seconds (in a daemon thread)
+class PeriodicDump(threading.Thread):
+    def __init__(self, metrics, f, interval = 10.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.f = f
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(self.f)
+
+    # stops dumping (after a final dump)
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.metrics.dump(self.f)
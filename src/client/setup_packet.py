@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import struct
+
+# USB 2.0, Section 9.3. Setup Data
+#
+# Compact decoder for setup packets. It provides the field names of the USB
+# specification as well as the names of the scapy layer usb_20.Setup, which is
+# only used for pretty-printing.
+SETUP_FORMAT = struct.Struct('<BBHHH')
+
+class SetupPacket(object):
+    __slots__ = ['bmRequestType', 'bRequest', 'wValue', 'wIndex', 'wLength']
+
+    DIR_HOST_TO_DEVICE = 0
+    DIR_DEVICE_TO_HOST = 1
+
+    TYPE_STANDARD = 0
+    TYPE_CLASS    = 1
+    TYPE_VENDOR   = 2
+    TYPE_RESERVED = 3
+
+    RCPT_DEVICE      = 0
+    RCPT_INTERFACE   = 1
+    RCPT_ENDPOINT    = 2
+    RCPT_OTHER       = 3
+
+    def __init__(self, data):
+        (self.bmRequestType, self.bRequest, self.wValue, self.wIndex,
+                self.wLength) = SETUP_FORMAT.unpack(data)
+
+    @property
+    def data_xfer_direction(self):
+        return self.bmRequestType >> 7
+
+    @property
+    def type(self):
+        return (self.bmRequestType >> 5) & 0x03
+
+    @property
+    def recipient(self):
+        return self.bmRequestType & 0x1f
+
+    @property
+    def request(self):
+        return self.bRequest
+
+    @property
+    def value(self):
+        return self.wValue
+
+    @property
+    def descriptor_index(self):
+        return self.wValue & 0xff
+
+    @property
+    def descriptor_type(self):
+        return self.wValue >> 8
+
+    @property
+    def index(self):
+        return self.wIndex
+
+    @property
+    def length(self):
+        return self.wLength
+
+    def __str__(self):
+        return SETUP_FORMAT.pack(self.bmRequestType, self.bRequest,
+                self.wValue, self.wIndex, self.wLength)
+
+    def __repr__(self):
+        return '<SetupPacket bmRequestType=0x%02x bRequest=%d wValue=0x%04x ' \
+                'wIndex=0x%04x wLength=%d>' % (self.bmRequestType,
+                        self.bRequest, self.wValue, self.wIndex, self.wLength)
+
+    # dissects the packet with the scapy layer
+    def dissect(self):
+        from usb_20 import Setup
+        return Setup(str(self))
+
+    def show(self):
+        self.dissect().show2()
@@ -0,0 +1,574 @@
+#!/usr/bin/python
+
+# Simulated Teensy++ 2.0 running tusbproxy
+#
+# SimulatedTeensy can be used in place of a serial.Serial object for
+# TeensyUSBProxy. It decodes the serial protocol implemented by
+# src/teensy/tusbproxy.c and executes the commands on a model of the
+# AT90USB1286 USB registers. The host side of the USB link is driven by
+# calling busReset(), sendSetup(), sendOut() and takeIn(). Setup packets are
+# answered from the descriptor store if the client enabled it (like the USB
+# interrupt of the firmware).
+
+import struct, time
+
+from teensy_usb_proxy import *
+
+COUNT_MASK = 0b00011111
+
+# number of argument bytes of extended commands
+EXT_ARGS = {
+        EXT_POLL   : 4,
+        EXT_MODIFY : 3,
+        EXT_BAUD   : 2,
+        EXT_DESC_ENABLE : 2,
+        }
+
+# capacity of the descriptor store of the firmware
+DESC_SIZE    = 2048
+DESC_ENTRIES = 32
+
+# USB 2.0, Table 9-4. Standard Request Codes (as handled by the firmware)
+GET_STATUS        = 0
+SET_ADDRESS       = 5
+GET_DESCRIPTOR    = 6
+GET_CONFIGURATION = 8
+SET_CONFIGURATION = 9
+
+# data space addresses of the modelled registers
+ADDR = dict((reg, ord(o) + (IO_OFFSET if t == TYPE_IO8 else 0))
+        for reg, (t, o) in REG.items())
+
+EP_ADDR = dict((ADDR[reg], reg) for reg in EP_REGS)
+
+NUM_ENDPOINTS = 7
+
+class SimulatedEndpoint:
+    def __init__(self, nr):
+        self.nr = nr
+        self.reset()
+
+    def reset(self):
+        self.regs = dict((reg, 0) for reg in EP_REGS)
+        self.fifo = ''      # data received from the host
+        self.bank = ''      # data to be sent to the host
+        self.packets = []   # IN packets not yet taken by the host
+        self.stalled = False
+
+    def isControl(self):
+        return (self.regs['UECFG0X'] & EP_TYPE_INTERRUPT) == EP_TYPE_CONTROL
+
+    def isIn(self):
+        return self.isControl() or (self.regs['UECFG0X'] & (1 << EPDIR)) != 0
+
+    def size(self):
+        return 8 << ((self.regs['UECFG1X'] >> EPSIZE0) & 0x07)
+
+class SimulatedTeensy:
+    def __init__(self, baudrate = 57600, delay = False, latency = 0.0):
+        # baud rate of the client side (set by the client), the Teensy side
+        # only receives bytes if its baud rate matches
+        self.baudrate = baudrate
+        self.deviceBaudrate = baudrate
+        self.syncBaudrate = None
+        self.timeout = None
+
+        # sleep for the time the bytes would need on a real link
+        self.delay = delay
+
+        # time (in s) added to every round-trip, e.g., by the latency timer of
+        # an USB serial adapter
+        self.latency = latency
+
+        # IN banks are freed as soon as they are sent (otherwise, only when
+        # the host takes the IN packets)
+        self.autoIn = True
+
+        self.mem = [0] * 256
+        # the device is detached after reset
+        self.mem[ADDR['UDCON']] = 1 << DETACH
+        self.endpoints = [SimulatedEndpoint(i) for i in range(NUM_ENDPOINTS)]
+        self.rx = ''
+        self.tx = ''
+
+        # descriptor store: (type, index, language id) -> descriptor
+        self.descriptors = {}
+        self.setupEnabled = False
+        self.setupPending = None
+        self.ep0Size = 0
+        self.configuration = 0
+
+        # a packet of the control IN transfer was dropped (EXT_IN_PACKET)
+        self.inFailed = False
+
+        self.resetStats()
+
+    def resetStats(self):
+        self.stats = {
+                'commands'       : 0,
+                'round_trips'    : 0,
+                'bytes_sent'     : 0,
+                'bytes_received' : 0,
+                'link_time'      : 0.0,
+                'overflows'      : 0,
+                'local_requests' : 0,
+                'attaches'       : 0,
+                }
+
+    # accounts for the time of n bytes on the link (plus some extra time)
+    def transfer(self, n, extra = 0.0):
+        t = n * 10.0 / self.baudrate + extra
+        self.stats['link_time'] += t
+        if self.delay:
+            time.sleep(t)
+
+
+    # serial interface (as used by TeensyUSBProxy)
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.stats['bytes_sent'] += len(data)
+        self.transfer(len(data))
+
+        if self.syncBaudrate is not None:
+            # the new baud rate needs to be confirmed
+            if self.linked() and data[:1] == chr(BAUD_SYNC):
+                self.tx += chr(BAUD_SYNC)
+                data = data[1:]
+            else:
+                self.deviceBaudrate = self.syncBaudrate
+            self.syncBaudrate = None
+
+        if self.linked():
+            self.rx += data
+            self.process()
+        return len(data)
+
+    def linked(self):
+        return abs(self.baudrate - self.deviceBaudrate) <= 0.03 * self.baudrate
+
+    def read(self, n = 1):
+        # like a serial port with a timeout, return what is available
+        data, self.tx = self.tx[:n], self.tx[n:]
+        if n > 0:
+            self.stats['round_trips'] += 1
+        self.stats['bytes_received'] += len(data)
+        self.transfer(len(data), self.latency if n > 0 else 0.0)
+        return data
+
+    def inWaiting(self):
+        return len(self.tx)
+
+    # the firmware returns to its initial rate and drops the command being
+    # received as well as the replies not sent yet
+    def send_break(self, duration = 0.25):
+        self.transfer(0, duration)
+        self.rx = ''
+        self.tx = ''
+        self.deviceBaudrate = BOOT_BAUDRATE
+        self.syncBaudrate = None
+
+    def flushInput(self):
+        self.tx = ''
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+    # protocol
+
+    def process(self):
+        # like the main loop of the firmware, enable the setup interrupt
+        # again before reading commands
+        self.rearm()
+
+        while self.rx:
+            cmd = ord(self.rx[0])
+
+            if (cmd & ~TYPE_MEM8) == CMD_EXT:
+                if len(self.rx) < 2:
+                    return
+                op = ord(self.rx[1])
+                n = self.extLength(op, self.rx[2:])
+                if n is None or len(self.rx) < 2 + n:
+                    return
+                self.extCommand(op, cmd & TYPE_MEM8, self.rx[2:2 + n])
+                self.rx = self.rx[2 + n:]
+                self.stats['commands'] += 1
+                continue
+
+            # determine how many bytes to read or write
+            if cmd & SMALL_N:
+                if len(self.rx) < 2:
+                    return
+                count = cmd & COUNT_MASK
+                i = 1
+            else:
+                if len(self.rx) < 3:
+                    return
+                count = ((cmd & COUNT_MASK) << 8) + ord(self.rx[1])
+                i = 2
+
+            addr = ord(self.rx[i])
+            if (cmd & TYPE_MEM8) == TYPE_IO8:
+                addr += IO_OFFSET
+            i += 1
+
+            if cmd & CMD_WRITE:
+                if len(self.rx) < i + count:
+                    return
+                for c in self.rx[i:i + count]:
+                    self.store(addr, ord(c))
+                i += count
+            else:
+                self.tx += ''.join(chr(self.load(addr)) for _ in range(count))
+
+            self.rx = self.rx[i:]
+            self.stats['commands'] += 1
+
+
+    # returns the number of argument bytes of an extended command (or None if
+    # not yet known)
+    def extLength(self, op, args):
+        if op == EXT_GATHER:
+            if not args:
+                return None
+            return 1 + ord(args[0])
+        if op == EXT_DESC_ADD:
+            if len(args) < 6:
+                return None
+            return 6 + struct.unpack('<H', args[4:6])[0]
+        if op == EXT_IN_PACKET:
+            if len(args) < 4:
+                return None
+            return 4 + ord(args[3])
+        return EXT_ARGS.get(op, 0)
+
+    def extCommand(self, op, t, args):
+        if op == EXT_POLL:
+            self.extPoll(t, args)
+        elif op == EXT_MODIFY:
+            self.extModify(t, args)
+        elif op == EXT_GATHER:
+            self.tx += ''.join(chr(self.load(ord(addr))) for addr in args[1:])
+        elif op == EXT_BAUD:
+            self.tx += chr(BAUD_ACK)
+            self.syncBaudrate = self.deviceBaudrate
+            self.deviceBaudrate = baudrate(struct.unpack('<H', args)[0])
+        elif op == EXT_DESC_CLEAR:
+            self.setupDisable()
+            self.descriptors = {}
+        elif op == EXT_DESC_ADD:
+            self.extDescAdd(args)
+        elif op == EXT_DESC_ENABLE:
+            size, enable = struct.unpack('<BB', args)
+            if enable and size:
+                self.ep0Size = size
+                self.setupEnabled = True
+                self.rearm()
+            else:
+                self.setupDisable()
+        elif op == EXT_SETUP:
+            self.extSetup()
+        elif op == EXT_IN_PACKET:
+            self.extInPacket(args)
+
+    def extPoll(self, t, args):
+        reg, mask, timeout = struct.unpack('<BBH', args)
+        if t == TYPE_IO8:
+            reg += IO_OFFSET
+
+        # registers only change in between commands, i.e., if the condition
+        # is not met, the poll times out
+        self.tx += chr(self.load(reg))
+
+    def extModify(self, t, args):
+        reg, clear, set = struct.unpack('<BBB', args)
+        if t == TYPE_IO8:
+            reg += IO_OFFSET
+        self.store(reg, (self.load(reg) & ~clear) | set)
+
+
+    def extInPacket(self, args):
+        flags, timeout, n = struct.unpack('<BHB', args[:4])
+        if flags & IN_FIRST:
+            self.inFailed = False
+        if n > IN_PACKET_SIZE:
+            self.inFailed = True
+        if self.inFailed:
+            self.tx += '\x00'
+            return
+
+        # as for EXT_POLL, the bank is either free already or the wait
+        # times out
+        ep = self.endpoint()
+        val = ep.regs['UEINTX']
+        if val & (1 << TXINI) and not val & ((1 << RXOUTI) | (1 << RXSTPI)):
+            for c in args[4:]:
+                self.store(ADDR['UEDATX'], ord(c))
+            self.storeUEINTX(ep, ~(1 << TXINI))
+        else:
+            self.inFailed = True
+        self.tx += chr(val)
+
+    def extDescAdd(self, args):
+        t, index, langid, length = struct.unpack('<BBHH', args[:6])
+        used = sum(len(desc) for desc in self.descriptors.values())
+        stored = not self.setupEnabled and \
+                len(self.descriptors) < DESC_ENTRIES and \
+                length <= DESC_SIZE - used
+        if stored:
+            self.descriptors[(t, index, langid)] = args[6:]
+        self.tx += chr(stored)
+
+    def extSetup(self):
+        if self.setupPending is None:
+            self.tx += '\x00' * 9
+            return
+
+        self.tx += '\x01' + self.setupPending
+        self.setupPending = None
+        ep = self.endpoints[0]
+        self.storeUEINTX(ep, ~((1 << RXSTPI) | (1 << RXOUTI) | (1 << TXINI)))
+        ep.regs['UEIENX'] |= (1 << RXSTPE)
+
+
+    # setup packets answered by the firmware
+
+    def rearm(self):
+        if not self.setupEnabled or self.setupPending is not None:
+            return
+        ep = self.endpoints[0]
+        if ep.regs['UECONX'] & (1 << EPEN) and \
+                not ep.regs['UEIENX'] & (1 << RXSTPE):
+            ep.regs['UEIENX'] |= (1 << RXSTPE)
+            # a setup packet received in the meantime triggers the interrupt
+            self.interrupt()
+
+    def setupDisable(self):
+        self.setupEnabled = False
+        self.endpoints[0].regs['UEIENX'] &= ~(1 << RXSTPE)
+
+    # models the setup interrupt, returns True if the setup packet was
+    # answered locally
+    def interrupt(self):
+        ep = self.endpoints[0]
+        if not (ep.regs['UEIENX'] & (1 << RXSTPE)) or \
+                not (ep.regs['UEINTX'] & (1 << RXSTPI)):
+            return False
+
+        data, ep.fifo = ep.fifo[:8], ep.fifo[8:]
+        response = self.setupLocal(data)
+        if response is None:
+            # forwarded to the client
+            self.setupPending = data
+            ep.regs['UEIENX'] &= ~(1 << RXSTPE)
+            return False
+
+        self.stats['local_requests'] += 1
+        self.storeUEINTX(ep, ~((1 << RXSTPI) | (1 << RXOUTI) | (1 << TXINI)))
+        wLength = struct.unpack('<H', data[6:8])[0]
+        response = response[:wLength]
+        size = self.ep0Size
+        packets = [response[i:i + size]
+                for i in range(0, len(response), size)]
+        if len(response) < wLength and len(response) % size == 0:
+            packets.append('')
+        ep.packets.extend(packets)
+        return True
+
+    # returns the data stage of a setup packet answered locally (or None)
+    def setupLocal(self, data):
+        bmRequestType, bRequest, wValue, wIndex, wLength = \
+                struct.unpack('<BBHHH', data)
+        if bRequest == GET_DESCRIPTOR and bmRequestType in [0x80, 0x81]:
+            return self.descriptors.get((wValue >> 8, wValue & 0xff, wIndex))
+        if bRequest == GET_STATUS and bmRequestType in [0x80, 0x81, 0x82]:
+            return '\x00\x00'
+        if bRequest == GET_CONFIGURATION and bmRequestType == 0x80:
+            return chr(self.configuration)
+        if bRequest == SET_ADDRESS and bmRequestType == 0x00:
+            self.configuration = 0
+        if bRequest == SET_CONFIGURATION and bmRequestType == 0x00:
+            self.configuration = wValue & 0xff
+        return None
+
+
+    # registers
+
+    def register(self, reg):
+        return self.load(ADDR[reg])
+
+    def endpoint(self):
+        return self.endpoints[self.mem[ADDR['UENUM']] % NUM_ENDPOINTS]
+
+    def load(self, addr):
+        if addr == ADDR['UEDATX']:
+            ep = self.endpoint()
+            if not ep.fifo:
+                return 0
+            c, ep.fifo = ep.fifo[0], ep.fifo[1:]
+            return ord(c)
+
+        if addr in EP_ADDR:
+            return self.endpoint().regs[EP_ADDR[addr]]
+
+        return self.mem[addr]
+
+    def store(self, addr, val):
+        val &= 0xff
+
+        if addr == ADDR['PLLCSR']:
+            # the PLL locks immediately
+            if val & (1 << PLLE):
+                val |= (1 << PLOCK)
+            else:
+                val &= ~(1 << PLOCK)
+
+        elif addr == ADDR['USBCON']:
+            if self.mem[addr] & (1 << USBE) and not val & (1 << USBE):
+                # disabling the controller resets it (but not the PLL)
+                self.controllerReset()
+
+        elif addr == ADDR['UDCON']:
+            if self.mem[addr] & (1 << DETACH) and not val & (1 << DETACH):
+                self.stats['attaches'] += 1
+
+        elif addr == ADDR['UDINT']:
+            # interrupt flags can only be cleared
+            val &= self.mem[addr]
+
+        elif addr == ADDR['UERST']:
+            for ep in self.endpoints:
+                if val & (1 << ep.nr):
+                    ep.fifo = ep.bank = ''
+                    ep.packets = []
+
+        elif addr == ADDR['UEDATX']:
+            ep = self.endpoint()
+            if len(ep.bank) < ep.size():
+                ep.bank += chr(val)
+            else:
+                # writes to a full bank are lost
+                self.stats['overflows'] += 1
+            return
+
+        elif addr == ADDR['UECONX']:
+            ep = self.endpoint()
+            if val & (1 << STALLRQ):
+                ep.stalled = True
+            if val & (1 << STALLRQC):
+                ep.stalled = False
+            ep.regs['UECONX'] = val & ~((1 << STALLRQ) | (1 << STALLRQC))
+            return
+
+        elif addr == ADDR['UECFG1X']:
+            ep = self.endpoint()
+            ep.regs['UECFG1X'] = val
+            if (val & (1 << ALLOC)) and ep.isIn():
+                # the bank is free for IN data
+                self.freeBank(ep)
+            return
+
+        elif addr == ADDR['UEINTX']:
+            self.storeUEINTX(self.endpoint(), val)
+            return
+
+        elif addr in EP_ADDR:
+            self.endpoint().regs[EP_ADDR[addr]] = val
+            return
+
+        self.mem[addr] = val
+
+    def storeUEINTX(self, ep, val):
+        old = ep.regs['UEINTX']
+        # interrupt flags can only be cleared
+        new = old & val
+        cleared = old & ~new
+        ep.regs['UEINTX'] = new
+
+        if cleared & (1 << RXSTPI):
+            ep.fifo = ''
+            # the bank is available for the data stage now
+            ep.regs['UEINTX'] |= (1 << TXINI)
+
+        if ep.isControl():
+            if cleared & (1 << RXOUTI):
+                ep.fifo = ''
+            if cleared & (1 << TXINI):
+                self.sendBank(ep)
+        elif ep.isIn():
+            # non-control IN banks are sent when FIFOCON is cleared
+            if cleared & (1 << FIFOCON):
+                self.sendBank(ep)
+        elif cleared & (1 << FIFOCON):
+            ep.fifo = ''
+
+    def sendBank(self, ep):
+        ep.packets.append(ep.bank)
+        ep.bank = ''
+        ep.regs['UEINTX'] &= ~((1 << TXINI) | (1 << RWAL) | (1 << FIFOCON))
+        if self.autoIn:
+            self.freeBank(ep)
+
+    def freeBank(self, ep):
+        ep.regs['UEINTX'] |= (1 << TXINI) | (1 << RWAL)
+        if not ep.isControl():
+            ep.regs['UEINTX'] |= (1 << FIFOCON)
+
+
+    def controllerReset(self):
+        for ep in self.endpoints:
+            ep.reset()
+        for reg in ['UDADDR', 'UDINT']:
+            self.mem[ADDR[reg]] = 0
+        self.mem[ADDR['UDCON']] = 1 << DETACH
+
+    # host side of the USB link
+
+    def busReset(self):
+        for ep in self.endpoints:
+            ep.reset()
+        self.mem[ADDR['UDADDR']] = 0
+        self.mem[ADDR['UDINT']] |= (1 << EORSTI)
+
+    # returns True if the setup packet was answered by the firmware
+    def sendSetup(self, data):
+        ep = self.endpoints[0]
+        ep.fifo = data
+        ep.bank = ''
+        ep.packets = []
+        ep.stalled = False
+        ep.regs['UEINTX'] &= ~(1 << TXINI)
+        ep.regs['UEINTX'] |= (1 << RXSTPI)
+        return self.interrupt()
+
+    def setup(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, wLength = 0):
+        return self.sendSetup(struct.pack('<BBHHH',
+            bmRequestType, bRequest, wValue, wIndex, wLength))
+
+    def sendOut(self, nr, data):
+        ep = self.endpoints[nr]
+        ep.fifo += data
+        ep.regs['UEINTX'] |= (1 << RXOUTI) | (1 << FIFOCON)
+
+    # returns the IN packets sent on the endpoint and frees its bank
+    def takeIn(self, nr):
+        ep = self.endpoints[nr]
+        packets, ep.packets = ep.packets, []
+        if packets:
+            self.freeBank(ep)
+        return packets
+
+    def stalled(self, nr):
+        return self.endpoints[nr].stalled
+
+    def address(self):
+        udaddr = self.mem[ADDR['UDADDR']]
+        if udaddr & (1 << ADDEN):
+            return udaddr & 0x7f
+        return 0
@@ -1,13 +1,80 @@
 #!/usr/bin/python
 
+import struct, time
+
+from metrics import Metrics
+
 CMD_READ  = 0b00000000
 CMD_WRITE = 0b10000000
 
+# extended commands (encoded as reads of zero bytes)
+CMD_EXT   = 0b00100000
+
 TYPE_IO8  = 0b00000000
 TYPE_MEM8 = 0b01000000
 
+# the I/O space is mapped into the data space at offset 0x20
+IO_OFFSET = 0x20
+
 SMALL_N   = 0b00100000
 
+# maximum count of a single read or write command (13 bit)
+MAX_COUNT = 0x1fff
+
+# extended opcodes
+EXT_POLL   = 0x01
+EXT_MODIFY = 0x02
+EXT_GATHER = 0x03
+EXT_BAUD   = 0x04
+
+# descriptor store and setup packets not answered by the Teensy
+EXT_DESC_CLEAR  = 0x05
+EXT_DESC_ADD    = 0x06
+EXT_DESC_ENABLE = 0x07
+EXT_SETUP       = 0x08
+
+# packet of a control IN data stage, dropped by the Teensy once a previous
+# packet of the transfer failed
+EXT_IN_PACKET   = 0x09
+IN_FIRST        = 0x01
+IN_PACKET_SIZE  = 64
+
+# maximum number of bytes of pipelined packet commands per transaction, well
+# below the receive buffer of the Teensy (1024 bytes) which fills up while
+# the Teensy waits for the host
+MAX_PIPELINE = 512
+
+# timeout (in ms) of a single poll command; the Teensy reads no commands while
+# it polls, hence longer waits are split into several polls by the client
+POLL_TIMEOUT = 100
+
+# baud rate switching handshake
+BAUD_ACK  = 0xa5
+BAUD_SYNC = 0x5a
+
+# baud rate of the Teensy after reset and after a break (see resync())
+BOOT_BAUDRATE = 57600
+
+# duration (in s) of the break resetting the baud rate of the Teensy
+BREAK_DURATION = 0.01
+
+# interval (in s) without input after which the line is considered quiet
+QUIET_INTERVAL = 0.02
+
+# clock of the Teensy++ 2.0
+F_CPU = 16000000
+
+# baud rates supported by the UART of the Teensy (at most 2.5% error)
+BAUDRATES = [57600, 115200, 250000, 500000, 1000000, 2000000]
+
+# UBRR1 value for a baud rate (as computed by uart_init())
+def ubrr(baud):
+    return (F_CPU / 4 / baud - 1) / 2
+
+# actual baud rate for an UBRR1 value
+def baudrate(ubrr):
+    return F_CPU / 8.0 / (ubrr + 1)
+
 REG = {
         'PLLCSR'  : (TYPE_IO8,  chr(0x29)),
         'PORTD'   : (TYPE_IO8,  chr(0x0b)),
@@ -18,6 +85,7 @@ REG = {
         'UECFG1X' : (TYPE_MEM8, chr(0xed)),
         'UECONX'  : (TYPE_MEM8, chr(0xeb)),
         'UEDATX'  : (TYPE_MEM8, chr(0xf1)),
+        'UEIENX'  : (TYPE_MEM8, chr(0xf0)),
         'UEINTX'  : (TYPE_MEM8, chr(0xe8)),
         'UENUM'   : (TYPE_MEM8, chr(0xe9)),
         'UERST'   : (TYPE_MEM8, chr(0xea)),
@@ -25,6 +93,13 @@ REG = {
         'USBCON'  : (TYPE_MEM8, chr(0xd8)),
         }
 
+# registers banked per endpoint (selected via UENUM)
+EP_REGS = ['UECONX', 'UECFG0X', 'UECFG1X', 'UEINTX', 'UEDATX', 'UEIENX']
+
+# registers (also) changed by the hardware or triggering actions when written,
+# i.e., registers that must not be cached by the shadow registers
+VOLATILE_REGS = ['PLLCSR', 'UDINT', 'UEDATX', 'UEIENX', 'UEINTX', 'UERST']
+
 # PLLCSR
 PLLP2   = 4
 PLLP1   = 3
@@ -77,6 +152,15 @@ RXOUTI   = 2
 STALLEDI = 1
 TXINI    = 0
 
+# UEIENX
+FLERRE   = 7
+NAKINE   = 6
+NAKOUTE  = 4
+RXSTPE   = 3
+RXOUTE   = 2
+STALLEDE = 1
+TXINE    = 0
+
 # UHWCON
 UIMOD  = 7
 UIDE   = 6
@@ -105,56 +189,467 @@ EP_SIZE = {
         256 : 0b01010000,
         }
 
-# TODO: separate proxy-specific parts from USB device-specific parts
+# converts register values to a string
+def pack(vals):
+    if type(vals) == int:
+        return chr(vals)
+    elif type(vals) == memoryview:
+        return vals.tobytes()
+    return vals
+
+# Queues register writes and reads so that they are sent to the Teensy as one
+# contiguous serial buffer (see TeensyUSBProxy.transaction())
+class Transaction:
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.depth = 0
+        self.cmds = []
+        self.lengths = []
+        self.decoders = []
+        self.results = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.proxy.tx = None
+            if exc_type is None:
+                self.flush()
+            else:
+                # the queued writes are dropped, but the shadow registers
+                # already hold their values
+                self.proxy.invalidate()
+        return False
+
+    def send(self, cmd):
+        self.cmds.append(cmd)
+
+    # queue a command with a response of n bytes, returns the index of its
+    # result in self.results (optionally decoded by decoder)
+    def request(self, cmd, n, decoder = None):
+        self.cmds.append(cmd)
+        self.lengths.append(n)
+        self.decoders.append(decoder)
+        return len(self.results) + len(self.lengths) - 1
+
+    def read(self, reg, n = 1):
+        return self.request(self.proxy.command(CMD_READ, reg, n), n)
+
+    def write(self, reg, vals):
+        cmd = self.proxy.writeCommand(reg, vals)
+        if cmd is not None:
+            self.send(cmd)
+
+    def poll(self, reg, mask, timeout = POLL_TIMEOUT):
+        return self.request(self.proxy.pollCommand(reg, mask, timeout), 1)
+
+    def modify(self, reg, clear, set):
+        cmd = self.proxy.modifyCommand(reg, clear, set)
+        if cmd is not None:
+            self.send(cmd)
+
+    def read_many(self, regs):
+        return self.request(self.proxy.gatherCommand(regs), len(regs),
+                lambda data: dict(zip(regs, map(ord, data))))
+
+    def flush(self):
+        t = time.time()
+        sent = 0
+        if self.cmds:
+            buf = ''.join(self.cmds)
+            self.proxy.ser.write(buf)
+            self.cmds = []
+            sent = len(buf)
+
+        if self.lengths:
+            data = self.proxy.ser.read(sum(self.lengths))
+            self.proxy.metrics.roundTrip(sent, len(data), time.time() - t)
+            i = 0
+            for n, decoder in zip(self.lengths, self.decoders):
+                if decoder is None:
+                    self.results.append(data[i:i + n])
+                else:
+                    self.results.append(decoder(data[i:i + n]))
+                i += n
+            self.lengths = []
+            self.decoders = []
+        elif sent:
+            self.proxy.metrics.sent(sent)
+
+        return self.results
+
+# Register-level access to the USB controller; request handling is done by
+# usb_device.USBDevice
 class TeensyUSBProxy:
-    def __init__(self, ser):
+    # with shadow registers enabled, the values of registers owned by the
+    # client are tracked and writes that would not change them are skipped
+    def __init__(self, ser, shadow = False, metrics = None):
         self.ser = ser
+        self.metrics = metrics if metrics is not None else Metrics()
         self.configuration = None
-
-    def read(self, reg, n = 1):
+        self.tx = None
+        self.shadow = {} if shadow else None
+        self.skippedWrites = 0
+
+        # standard requests are answered by the Teensy from its descriptor
+        # store, other setup packets are read via readSetup()
+        self.descriptorStore = False
+
+    # returns the (current) transaction; register accesses within a
+    # with-block are sent as a single serial buffer when the block is left
+    def transaction(self):
+        if self.tx is None:
+            self.tx = Transaction(self)
+        return self.tx
+
+    def command(self, cmd, reg, n):
         t,o = REG[reg]
+        if cmd == CMD_WRITE:
+            self.metrics.writes[reg] += 1
+        else:
+            self.metrics.reads[reg] += 1
         if n < 32:
-            self.ser.write(chr(CMD_READ | t | SMALL_N | n) + o)
+            return chr(cmd | t | SMALL_N | n) + o
+        elif n <= MAX_COUNT:
+            return chr(cmd | t | (n >> 8)) + chr(n % 256) + o
         else:
-            self.ser.write(chr(CMD_READ | t | (n >> 8)) + (n % 256) + o)
-        return self.ser.read(n)
+            raise ValueError('count %d exceeds %d' % (n, MAX_COUNT))
 
-    def write(self, reg, vals):
+    def extCommand(self, op, reg, args = ''):
         t,o = REG[reg]
-
-        if type(vals) == int:
-            vals = chr(vals)
-
-        n = len(vals)
-
-        if n < 32:
-            self.ser.write(chr(CMD_WRITE | t | SMALL_N | n) + o + vals)
+        return chr(CMD_EXT | t) + chr(op) + o + args
+
+    # timeout in ms (0 to read reg once)
+    def pollCommand(self, reg, mask, timeout = POLL_TIMEOUT):
+        if not 0 <= timeout <= 0xffff:
+            raise ValueError('poll timeout %r out of range' % timeout)
+        self.metrics.polls[reg] += 1
+        return self.extCommand(EXT_POLL, reg,
+                chr(mask) + struct.pack('<H', timeout))
+
+    # returns the write command (or None if the write can be skipped)
+    def writeCommand(self, reg, vals):
+        vals = pack(vals)
+        if self.shadow is not None and vals and self.shadowWrite(reg, vals):
+            self.skippedWrites += 1
+            self.metrics.skipped[reg] += 1
+            return None
+        return ''.join(self.command(CMD_WRITE, reg, len(vals[i:i + MAX_COUNT]))
+                + vals[i:i + MAX_COUNT] for i in range(0, len(vals), MAX_COUNT))
+
+    # returns the modify command (or None if the modification can be skipped)
+    def modifyCommand(self, reg, clear, set):
+        if self.shadow is not None:
+            key = self.shadowKey(reg)
+            if key in self.shadow:
+                val = (self.shadow[key] & ~clear) | set
+                if self.shadowWrite(reg, chr(val & 0xff)):
+                    self.skippedWrites += 1
+                    self.metrics.skipped[reg] += 1
+                    return None
+            elif key is not None:
+                self.shadow.pop(key, None)
+        self.metrics.modifies[reg] += 1
+        return self.extCommand(EXT_MODIFY, reg, chr(clear & 0xff) + chr(set))
+
+    def gatherCommand(self, regs):
+        addrs = ''
+        for reg in regs:
+            self.metrics.reads[reg] += 1
+            t,o = REG[reg]
+            addrs += chr(ord(o) + IO_OFFSET) if t == TYPE_IO8 else o
+        return chr(CMD_EXT | TYPE_MEM8) + chr(EXT_GATHER) + chr(len(regs)) + addrs
+
+    def send(self, cmd):
+        if self.tx is not None:
+            self.tx.send(cmd)
         else:
-            self.ser.write(chr(CMD_WRITE | t | (n >> 8)) + (n % 256) + o + vals)
+            self.ser.write(cmd)
+            self.metrics.sent(len(cmd))
+
+    def request(self, cmd, n):
+        if self.tx is not None:
+            # requests need a response, hence send everything queued so far
+            i = self.tx.request(cmd, n)
+            return self.tx.flush()[i]
+
+        t = time.time()
+        self.ser.write(cmd)
+        data = self.ser.read(n)
+        self.metrics.roundTrip(len(cmd), len(data), time.time() - t)
+        return data
+
+    # shadow registers
+
+    # returns the key of a cacheable register (or None)
+    def shadowKey(self, reg):
+        if reg in VOLATILE_REGS:
+            return None
+        if reg in EP_REGS:
+            # banked registers can only be cached if the endpoint is known
+            if 'UENUM' not in self.shadow:
+                return None
+            return (reg, self.shadow['UENUM'])
+        return reg
+
+    # updates the shadow registers, returns True if the write can be skipped
+    def shadowWrite(self, reg, vals):
+        key = self.shadowKey(reg)
+        if key is None:
+            return False
+
+        val = ord(vals[-1])
+        if len(vals) == 1 and self.shadow.get(key) == val:
+            return True
+
+        if reg == 'UECONX' and val & ((1 << STALLRQ) | (1 << STALLRQC)):
+            # strobe bits are cleared by the hardware
+            self.shadow.pop(key, None)
+        elif reg == 'USBCON' and not val & (1 << USBE):
+            # disabling the USB controller resets it
+            self.invalidate()
+            self.shadow[key] = val
+        else:
+            self.shadow[key] = val
+        return False
 
-    def waitForInterrupt(self, reg, intrMask):
-        intr = ord(self.read(reg))
-        while (intr & intrMask) == 0:
-            intr = ord(self.read(reg))
+    # forgets the shadowed register values (e.g., after a bus reset)
+    def invalidate(self):
+        if self.shadow is not None:
+            self.shadow.clear()
 
-        return intr
+    def read(self, reg, n = 1):
+        t = time.time()
+        cmd = ''.join(self.command(CMD_READ, reg, min(n - i, MAX_COUNT))
+                for i in range(0, n, MAX_COUNT))
+        vals = self.request(cmd, n)
+        if self.shadow is not None and len(vals) == 1:
+            key = self.shadowKey(reg)
+            if key is not None:
+                self.shadow[key] = ord(vals)
+        self.metrics.latency['read'].add(time.time() - t)
+        return vals
+
+    def write(self, reg, vals):
+        cmd = self.writeCommand(reg, vals)
+        if cmd is not None:
+            self.send(cmd)
+
+    # reads several registers in one request, returns a dict mapping the
+    # registers to their values
+    def read_many(self, regs):
+        return dict(zip(regs, map(ord,
+            self.request(self.gatherCommand(regs), len(regs)))))
+
+    # waits on the Teensy until (reg & mask) != 0 or the timeout (in ms, 0 to
+    # read reg once) expires, returns the final value of reg
+    def poll(self, reg, mask, timeout = POLL_TIMEOUT):
+        return ord(self.request(self.pollCommand(reg, mask, timeout), 1))
+
+    # waits until (reg & intrMask) != 0 by issuing polls of POLL_TIMEOUT ms,
+    # gives up after timeout ms (None to wait until interrupted); returns the
+    # final value of reg
+    def waitForInterrupt(self, reg, intrMask, timeout = None):
+        t = time.time()
+        deadline = None if timeout is None else t + timeout / 1000.0
+        while True:
+            val = self.poll(reg, intrMask, POLL_TIMEOUT if timeout is None
+                    else min(timeout, POLL_TIMEOUT))
+            if val & intrMask or (deadline is not None and
+                    time.time() >= deadline):
+                break
+        self.metrics.latency['waitForInterrupt'].add(time.time() - t)
+        return val
+
+    # atomically clears and sets bits of reg on the Teensy
+    def modify(self, reg, clear, set):
+        cmd = self.modifyCommand(reg, clear, set)
+        if cmd is not None:
+            self.send(cmd)
+
+    # timeout in ms, first marks the first packet of a transfer
+    def inPacketCommand(self, packet, first, timeout = POLL_TIMEOUT):
+        packet = pack(packet)
+        if not 0 <= timeout <= 0xffff:
+            raise ValueError('poll timeout %r out of range' % timeout)
+        if len(packet) > IN_PACKET_SIZE:
+            raise ValueError('packet size %d exceeds %d' %
+                    (len(packet), IN_PACKET_SIZE))
+        self.metrics.polls['UEINTX'] += 1
+        self.metrics.writes['UEDATX'] += 1
+        return chr(CMD_EXT | TYPE_MEM8) + chr(EXT_IN_PACKET) + \
+                struct.pack('<BHB', IN_FIRST if first else 0, timeout,
+                        len(packet)) + packet
+
+    # sends the data stage of a control IN transfer (on the selected endpoint)
+    #
+    # The data (truncated to the length requested by the host) is split into
+    # packets of maxPacketSize bytes, followed by a zero-length packet if the
+    # data is shorter than requested and ends on a packet boundary. The
+    # packets are pipelined, up to MAX_PIPELINE bytes per serial buffer: the
+    # Teensy waits for TXINI before filling the bank and drops the remaining
+    # packets once the host aborts the data stage (RXOUTI or RXSTPI) or a wait
+    # times out. The timeout (in ms) applies to every packet. Returns False if
+    # a packet could not be sent.
+    def controlIn(self, data, length, maxPacketSize = 32, timeout = 100):
+        data = data[:length]
+        packets = [data[i:i + maxPacketSize]
+                for i in range(0, len(data), maxPacketSize)]
+        if len(data) < length and len(data) % maxPacketSize == 0:
+            packets.append('')
+
+        abort = (1 << RXOUTI) | (1 << RXSTPI)
+        i = 0
+        while i < len(packets):
+            results = []
+            size = 0
+            with self.transaction() as tx:
+                while i < len(packets):
+                    # command byte, opcode, flags, timeout and length
+                    n = 6 + len(packets[i])
+                    if results and size + n > MAX_PIPELINE:
+                        break
+                    results.append(tx.request(self.inPacketCommand(packets[i],
+                        i == 0, timeout), 1))
+                    size += n
+                    i += 1
+
+            for r in results:
+                val = ord(tx.results[r] or '\x00')
+                if not val & (1 << TXINI) or val & abort:
+                    return False
+        return True
+
+    # switches the baud rate of the Teensy and the serial port, falls back to
+    # the current baud rate if the Teensy cannot be reached at the new one;
+    # returns True if the baud rate was switched
+    def set_baud(self, baud):
+        old = self.ser.baudrate
+        if self.switchBaud(baud):
+            return True
+
+        # the Teensy switched anyway if only its BAUD_SYNC got lost
+        self.resync(old)
+        return False
+
+    # resets the Teensy to BOOT_BAUDRATE by sending a break and switches to
+    # baud, e.g., if the rate of the Teensy is unknown after restarting the
+    # client. The Teensy takes the break as a zero byte with a frame error at
+    # any rate, drops the command it is receiving (if any) and the bytes
+    # received so far. Probing other rates is avoided as bytes received at the
+    # wrong rate are executed as arbitrary commands. Returns True if the
+    # Teensy is reached at baud.
+    def resync(self, baud = BOOT_BAUDRATE):
+        self.ser.baudrate = BOOT_BAUDRATE
+        self.ser.send_break(BREAK_DURATION)
+        time.sleep(BREAK_DURATION)
+        self.drain()
+        self.invalidate()
+        if baud != BOOT_BAUDRATE:
+            return self.switchBaud(baud)
+
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.5
+        try:
+            return len(self.request(self.pollCommand('UDCON', 0, 0), 1)) == 1
+        finally:
+            self.ser.timeout = timeout
+
+    # discards input until the line is quiet for QUIET_INTERVAL, gives up
+    # after timeout (in s); bytes still in transit when the Teensy switched
+    # its rate arrive garbled
+    def drain(self, timeout = 1.0):
+        old = self.ser.timeout
+        self.ser.timeout = QUIET_INTERVAL
+        deadline = time.time() + timeout
+        try:
+            while self.ser.read(256) and time.time() < deadline:
+                pass
+        finally:
+            self.ser.timeout = old
+
+    # runs the baud rate handshake, returns True if the Teensy confirmed the
+    # new rate
+    def switchBaud(self, baud):
+        u = ubrr(baud)
+        if u < 0 or abs(baudrate(u) - baud) / baud > 0.025:
+            raise ValueError('unsupported baud rate %d' % baud)
+
+        old = self.ser.baudrate
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.5
+        try:
+            self.ser.write(chr(CMD_EXT) + chr(EXT_BAUD) + struct.pack('<H', u))
+            if self.ser.read(1) != chr(BAUD_ACK):
+                return False
+
+            self.ser.baudrate = baud
+            self.ser.write(chr(BAUD_SYNC))
+            if self.ser.read(1) == chr(BAUD_SYNC):
+                return True
+
+            # the Teensy falls back to the old rate if not confirmed
+            self.ser.baudrate = old
+            time.sleep(0.2)
+            self.ser.flushInput()
+            return False
+        finally:
+            self.ser.timeout = timeout
+
+    # descriptor store
+
+    def storeCommand(self, op, args = ''):
+        return chr(CMD_EXT | TYPE_MEM8) + chr(op) + args
+
+    # uploads the descriptors of a DescriptorTable to the Teensy and enables
+    # answering standard requests locally; returns the keys of the descriptors
+    # that did not fit into the store
+    def uploadDescriptors(self, table, ep0Size = 32):
+        with self.transaction() as tx:
+            self.send(self.storeCommand(EXT_DESC_CLEAR))
+            results = []
+            for (t, index, langid), desc in sorted(table.items()):
+                results.append(((t, index, langid), tx.request(
+                    self.storeCommand(EXT_DESC_ADD,
+                        struct.pack('<BBHH', t, index, langid, len(desc))
+                        + desc.tobytes()), 1)))
+            self.send(self.storeCommand(EXT_DESC_ENABLE,
+                chr(ep0Size) + '\x01'))
+        self.descriptorStore = True
+        return [key for key, i in results if tx.results[i] != '\x01']
+
+    def disableDescriptors(self):
+        self.send(self.storeCommand(EXT_DESC_ENABLE, '\x00\x00'))
+        self.descriptorStore = False
+
+    # returns the pending setup packet not answered by the Teensy (or None),
+    # the Teensy acknowledges it
+    def readSetup(self):
+        data = self.request(self.storeCommand(EXT_SETUP), 9)
+        if data[:1] != '\x01':
+            return None
+        return data[1:]
 
     def led_on(self):
-        self.write('PORTD', ord(self.read('PORTD')) | (1 << 6))
+        self.modify('PORTD', 0, 1 << 6)
 
     def led_off(self):
-        self.write('PORTD', ord(self.read('PORTD')) & ~(1 << 6))
+        self.modify('PORTD', 1 << 6, 0)
 
 
     def init(self):
-        # enable device mode and USB pad
-        self.write('UHWCON', (1 << UIMOD) | (1 << UVREGE))
+        with self.transaction():
+            # enable device mode and USB pad
+            self.write('UHWCON', (1 << UIMOD) | (1 << UVREGE))
 
-        # enable USB, but freeze clock for now
-        self.write('USBCON', (1 << USBE) | (1 << FRZCLK))
+            # enable USB, but freeze clock for now
+            self.write('USBCON', (1 << USBE) | (1 << FRZCLK))
 
-        # enable PLL and configure PLL input prescale
-        self.write('PLLCSR', (1 << PLLP2) | (1 << PLLP0) | (1 << PLLE))
+            # enable PLL and configure PLL input prescale
+            self.write('PLLCSR', (1 << PLLP2) | (1 << PLLP0) | (1 << PLLE))
 
         # wait for PLL to be locked to the reference clock
         while (ord(self.read('PLLCSR')) & (1 << PLOCK)) == 0:
@@ -179,15 +674,33 @@ class TeensyUSBProxy:
         self.write('UDCON', 1 << DETACH)
         self.led_off()
 
+    # detaches, resets the USB controller and attaches again in a single
+    # serial buffer; the PLL keeps running, hence there is no need to wait for
+    # it to lock. Disabling the controller resets the endpoint configuration
+    # and the address, the control endpoint is set up again on the bus reset
+    # by the host (see USBDevice.poll()).
+    def reenumerate(self):
+        with self.transaction() as tx:
+            if self.descriptorStore:
+                # acknowledge a setup packet still pending on the Teensy,
+                # the firmware does not rearm the setup interrupt otherwise
+                tx.request(self.storeCommand(EXT_SETUP), 9)
+            self.write('UDCON', 1 << DETACH)
+            self.write('USBCON', 0x00)
+            self.write('USBCON', (1 << USBE) | (1 << OTGPADE))
+            self.write('UDCON', 0x00)
+        self.configuration = None
+
     def setupEndpoint(self, nr, epType, size):
-        # select EP
-        self.write('UENUM', nr)
+        with self.transaction():
+            # select EP
+            self.write('UENUM', nr)
 
-        # enable EP
-        self.write('UECONX', 1 << EPEN)
+            # enable EP
+            self.write('UECONX', 1 << EPEN)
 
-        # set EP type
-        self.write('UECFG0X', epType)
+            # set EP type
+            self.write('UECFG0X', epType)
 
-        # set EP size (and single buffer)
-        self.write('UECFG1X', EP_SIZE[size] | 0x02)
+            # set EP size (and single buffer)
+            self.write('UECFG1X', EP_SIZE[size] | 0x02)
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# Tests of the client against the simulated Teensy (see teensy_sim.py), run
+# with: python -m unittest test_sim
+
+import unittest
+
+import trollius as asyncio
+
+from async_proxy import open_simulated
+from teensy_sim import *
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedTeensy()
+        self.u = TeensyUSBProxy(self.sim, shadow = True)
+
+    def test_exception_invalidates_shadow(self):
+        try:
+            with self.u.transaction():
+                self.u.write('UDADDR', 5)
+                raise RuntimeError('abort')
+        except RuntimeError:
+            pass
+        self.assertEqual(self.sim.mem[ADDR['UDADDR']], 0)
+        self.assertEqual(self.u.shadow, {})
+
+        # the write is not skipped, the read goes to the link
+        bytes_sent = self.sim.stats['bytes_sent']
+        self.u.write('UDADDR', 5)
+        self.assertGreater(self.sim.stats['bytes_sent'], bytes_sent)
+        self.assertEqual(self.sim.mem[ADDR['UDADDR']], 5)
+
+        round_trips = self.sim.stats['round_trips']
+        self.assertEqual(ord(self.u.read('UDADDR')), 5)
+        self.assertEqual(self.sim.stats['round_trips'], round_trips + 1)
+
+# replies sent before a break that are still in transit afterwards
+class LateTeensy(SimulatedTeensy):
+    def send_break(self, duration = 0.25):
+        SimulatedTeensy.send_break(self, duration)
+        self.late = '\xa5\x00\xff'
+
+    def read(self, n = 1):
+        self.tx, self.late = getattr(self, 'late', '') + self.tx, ''
+        return SimulatedTeensy.read(self, n)
+
+class ResyncTest(unittest.TestCase):
+    def test_late_replies(self):
+        sim = LateTeensy()
+        u = TeensyUSBProxy(sim)
+        self.assertTrue(u.resync())
+        self.assertEqual(ord(u.read('UDCON')), 1 << DETACH)
+
+class ControlInTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedTeensy()
+        self.u = TeensyUSBProxy(self.sim)
+        self.u.setupEndpoint(0, EP_TYPE_CONTROL, 64)
+        # GET_DESCRIPTOR (device) not answered by the firmware, acknowledged
+        # by the client
+        self.sim.setup(0x80, 6, 0x0100, 0, 255)
+        self.u.write('UEINTX', ~(1 << RXSTPI) & 0xff)
+
+    def test_packets(self):
+        self.assertTrue(self.u.controlIn('x' * 64, 255, 32))
+        self.assertEqual(self.sim.takeIn(0), ['x' * 32, 'x' * 32, ''])
+
+    def test_pipeline_limit(self):
+        round_trips = self.sim.stats['round_trips']
+        self.assertTrue(self.u.controlIn('x' * 2048, 2048, 64))
+        self.assertEqual(self.sim.takeIn(0), ['x' * 64] * 32)
+        # 7 commands of 70 bytes fit into MAX_PIPELINE bytes
+        self.assertEqual(self.sim.stats['round_trips'] - round_trips, 5)
+
+    def test_abort(self):
+        # the host aborts the data stage
+        self.sim.sendOut(0, '')
+        self.assertFalse(self.u.controlIn('x' * 64, 255, 32))
+        self.assertEqual(self.sim.takeIn(0), [])
+
+    def test_timeout_drops_remaining(self):
+        # the host does not fetch the first packet, the later ones are dropped
+        self.sim.autoIn = False
+        self.assertFalse(self.u.controlIn('x' * 64, 255, 32, timeout = 0))
+        self.assertEqual(self.sim.takeIn(0), ['x' * 32])
+
+# the host resets the bus during the third poll
+class ResettingTeensy(SimulatedTeensy):
+    def extPoll(self, t, args):
+        self.polls = getattr(self, 'polls', 0) + 1
+        if self.polls == 3:
+            self.busReset()
+        SimulatedTeensy.extPoll(self, t, args)
+
+class AsyncWaitTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = ResettingTeensy()
+        self.loop = asyncio.new_event_loop()
+        self.u = open_simulated(self.sim, loop = self.loop)
+
+    def tearDown(self):
+        self.u.close()
+        self.loop.close()
+
+    def test_repolls(self):
+        val = self.loop.run_until_complete(
+                self.u.wait_for('UDINT', 1 << EORSTI))
+        self.assertTrue(val & (1 << EORSTI))
+        self.assertEqual(self.sim.polls, 3)
+
+    def test_timeout(self):
+        val = self.loop.run_until_complete(
+                self.u.wait_for('UDINT', 1 << EORSTI, 0))
+        self.assertFalse(val & (1 << EORSTI))
+        self.assertEqual(self.sim.polls, 1)
+
+if __name__ == "__main__":
+    unittest.main()
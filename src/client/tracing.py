@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# Leveled tracing
+#
+# Messages are only formatted if their level is enabled. A message is either a
+# format string with its arguments or a callable returning the message (e.g.,
+# for expensive scapy dissections). Optionally, the most recent events are
+# kept unformatted in a ring buffer that can be dumped when something goes
+# wrong.
+
+import collections, sys, time
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+OFF     = 100
+
+LEVEL_NAMES = {
+        DEBUG   : 'DEBUG',
+        INFO    : 'INFO',
+        WARNING : 'WARNING',
+        ERROR   : 'ERROR',
+        }
+
+def render(msg, args):
+    if callable(msg):
+        return msg(*args)
+    if args:
+        return msg % args
+    return msg
+
+class Tracer:
+    # ring is the number of events kept in the ring buffer (0 to disable it),
+    # ringLevel the minimum level of the events kept
+    # out defaults to the current sys.stdout
+    def __init__(self, level = INFO, out = None, ring = 0,
+            ringLevel = DEBUG):
+        self.out = out
+        self.ring = collections.deque(maxlen = ring) if ring else None
+        self.ringLevel = ringLevel
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        self.level = level
+
+        # minimum level of events that need to be processed at all
+        self.threshold = level
+        if self.ring is not None:
+            self.threshold = min(level, self.ringLevel)
+
+    def enabled(self, level):
+        return level >= self.threshold
+
+    def trace(self, level, msg, *args):
+        if level < self.threshold:
+            return
+
+        if self.ring is not None and level >= self.ringLevel:
+            self.ring.append((time.time(), level, msg, args))
+
+        if level >= self.level:
+            (self.out or sys.stdout).write(render(msg, args) + '\n')
+
+    def debug(self, msg, *args):
+        if DEBUG >= self.threshold:
+            self.trace(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        if INFO >= self.threshold:
+            self.trace(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        if WARNING >= self.threshold:
+            self.trace(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        if ERROR >= self.threshold:
+            self.trace(ERROR, msg, *args)
+
+    # writes the events of the ring buffer (oldest first)
+    def dump(self, out = None):
+        if self.ring is None:
+            return
+
+        out = out or self.out or sys.stdout
+        for t, level, msg, args in self.ring:
+            out.write('%.6f %-7s %s\n' % (t, LEVEL_NAMES.get(level, level),
+                render(msg, args)))
@@ -4,6 +4,7 @@ from scapy.all import *
 
 from class_code import CLASS_CODE
 from langid import LANGID
+from usb_20_defs import *
 
 class XLEShortField(LEShortField):
     def i2repr(self, pkt, x):
@@ -41,33 +42,6 @@ class MyBitMultiEnumField(BitField,MultiEnumField):
             return self.s2i_multi[v].get(x,x)
         return x
 
-# Table 9-4. Standard Request Codes
-REQUEST_CODE = {
-        'GET_STATUS'        : 0,
-        'CLEAR_FEATURE'     : 1,
-        'SET_FEATURE'       : 3,
-        'SET_ADDRESS'       : 5, 
-        'GET_DESCRIPTOR'    : 6,
-        'SET_DESCRIPTOR'    : 7,
-        'GET_CONFIGURATION' : 8,
-        'SET_CONFIGURATION' : 9,
-        'GET_INTERFACE'     : 10,
-        'SET_INTERFACE'     : 11,
-        'SYNCH_FRAME'       : 12,
-        }
-
-# Table 9-5. Descriptor Types
-DESCRIPTOR_TYPE = {
-        'DEVICE'                            : 1,
-        'CONFIGURATION'                     : 2,
-        'STRING'                            : 3,
-        'INTERFACE'                         : 4,
-        'ENDPOINT'                          : 5,
-        'DEVICE_QUALIFIER'                  : 6,
-        'OTHER_SPEED_CONFIGURATION'         : 7,
-        'INTERFACE_POWER'                   : 8
-        }
-
 # Section 9.3. Setup Data
 class Setup(Packet):
     name = 'USB Setup Packet'
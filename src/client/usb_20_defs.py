@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Definitions for USB 2.0 requests and standard descriptors
+#
+# The constants and descriptor builders do not depend on scapy, i.e., the
+# runtime (proxy, setup decoding, descriptor serving) starts without loading
+# it. The scapy layers in usb_20.py are only needed to dissect descriptors.
+
+import struct
+
+from langid import LANGID
+
+# Table 9-4. Standard Request Codes
+REQUEST_CODE = {
+        'GET_STATUS'        : 0,
+        'CLEAR_FEATURE'     : 1,
+        'SET_FEATURE'       : 3,
+        'SET_ADDRESS'       : 5,
+        'GET_DESCRIPTOR'    : 6,
+        'SET_DESCRIPTOR'    : 7,
+        'GET_CONFIGURATION' : 8,
+        'SET_CONFIGURATION' : 9,
+        'GET_INTERFACE'     : 10,
+        'SET_INTERFACE'     : 11,
+        'SYNCH_FRAME'       : 12,
+        }
+
+# Table 9-5. Descriptor Types
+DESCRIPTOR_TYPE = {
+        'DEVICE'                            : 1,
+        'CONFIGURATION'                     : 2,
+        'STRING'                            : 3,
+        'INTERFACE'                         : 4,
+        'ENDPOINT'                          : 5,
+        'DEVICE_QUALIFIER'                  : 6,
+        'OTHER_SPEED_CONFIGURATION'         : 7,
+        'INTERFACE_POWER'                   : 8
+        }
+
+# Table 9-10. bmAttributes (bit 7 is reserved and set to one)
+CONFIGURATION_RESERVED      = 0x80
+CONFIGURATION_SELF_POWERED  = 0x40
+CONFIGURATION_REMOTE_WAKEUP = 0x20
+
+# Table 9-13. bEndpointAddress and bmAttributes
+ENDPOINT_OUT = 0
+ENDPOINT_IN  = 1
+
+ENDPOINT_CONTROL     = 0
+ENDPOINT_ISOCHRONOUS = 1
+ENDPOINT_BULK        = 2
+ENDPOINT_INTERRUPT   = 3
+
+# The builders below return serialized descriptors (strings). Their keyword
+# arguments are named like the fields of the scapy layers in usb_20.py.
+
+# prepends bLength and bDescriptorType
+def descriptor(descriptor_type, body):
+    return chr(2 + len(body)) + chr(descriptor_type) + body
+
+# Table 9-8. Standard Device Descriptor
+def deviceDescriptor(usb = 0x0200, device_class = 0, device_subclass = 0,
+        device_protocol = 0, max_packet_size_0 = 64, id_vendor = 0,
+        id_product = 0, device = 0, manufacturer = 0, product = 0,
+        serial_number = 0, num_configurations = 0):
+    return descriptor(DESCRIPTOR_TYPE['DEVICE'], struct.pack('<HBBBBHHHBBBB',
+        usb, device_class, device_subclass, device_protocol,
+        max_packet_size_0, id_vendor, id_product, device, manufacturer,
+        product, serial_number, num_configurations))
+
+# Table 9-10. Standard Configuration Descriptor
+# descriptors are the serialized interface, class and endpoint descriptors
+# following the configuration descriptor, num_interfaces defaults to the
+# number of interface descriptors among them
+def configurationDescriptor(descriptors, num_interfaces = None,
+        configuration_value = 1, configuration = 0,
+        attributes = CONFIGURATION_RESERVED | CONFIGURATION_SELF_POWERED |
+        CONFIGURATION_REMOTE_WAKEUP, max_power = 50):
+    if num_interfaces is None:
+        num_interfaces = len([d for d in descriptors
+            if ord(d[1]) == DESCRIPTOR_TYPE['INTERFACE']])
+    pay = ''.join(descriptors)
+    return descriptor(DESCRIPTOR_TYPE['CONFIGURATION'], struct.pack('<HBBBBB',
+        9 + len(pay), num_interfaces, configuration_value, configuration,
+        attributes, max_power)) + pay
+
+# Table 9-12. Standard Interface Descriptor
+def interfaceDescriptor(interface_number = 0, alternate_setting = 0,
+        num_endpoints = 0, interface_class = 0, interface_subclass = 0,
+        interface_protocol = 0, interface = 0):
+    return descriptor(DESCRIPTOR_TYPE['INTERFACE'], struct.pack('<BBBBBBB',
+        interface_number, alternate_setting, num_endpoints, interface_class,
+        interface_subclass, interface_protocol, interface))
+
+# Table 9-13. Standard Endpoint Descriptor
+def endpointDescriptor(endpoint_number, endpoint_direction = ENDPOINT_OUT,
+        transfer_type = ENDPOINT_CONTROL, max_packet_size = 0, interval = 0,
+        sync_type = 0, usage_type = 0):
+    return descriptor(DESCRIPTOR_TYPE['ENDPOINT'], struct.pack('<BBHB',
+        (endpoint_direction << 7) | endpoint_number,
+        (usage_type << 4) | (sync_type << 2) | transfer_type,
+        max_packet_size, interval))
+
+# Table 9-15. String Descriptor Zero
+def stringDescriptorZero(langids = [LANGID['English (United States)']]):
+    return descriptor(DESCRIPTOR_TYPE['STRING'],
+            struct.pack('<%dH' % len(langids), *langids))
+
+# Table 9-16. UNICODE String Descriptor
+def stringDescriptor(string):
+    return descriptor(DESCRIPTOR_TYPE['STRING'],
+            unicode(string).encode('utf_16_le'))
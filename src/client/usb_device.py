@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+# USB device framework on top of TeensyUSBProxy
+#
+# Requests are dispatched via a dict keyed by (bmRequestType, bRequest), i.e.,
+# by direction, type, recipient and request code. Device classes register
+# handlers for their class and vendor requests; requests without a handler
+# are stalled. Static responses are serialized once at registration.
+
+import time
+
+from usb_20_defs import REQUEST_CODE
+from setup_packet import SetupPacket
+from teensy_usb_proxy import *
+from tracing import *
+
+# returns the bmRequestType of requests with the given direction, type and
+# recipient (see SetupPacket)
+def requestType(direction, type, recipient):
+    return (direction << 7) | (type << 5) | recipient
+
+STANDARD_DEVICE_OUT = requestType(SetupPacket.DIR_HOST_TO_DEVICE,
+        SetupPacket.TYPE_STANDARD, SetupPacket.RCPT_DEVICE)
+STANDARD_DEVICE_IN = requestType(SetupPacket.DIR_DEVICE_TO_HOST,
+        SetupPacket.TYPE_STANDARD, SetupPacket.RCPT_DEVICE)
+STANDARD_INTERFACE_IN = requestType(SetupPacket.DIR_DEVICE_TO_HOST,
+        SetupPacket.TYPE_STANDARD, SetupPacket.RCPT_INTERFACE)
+STANDARD_ENDPOINT_IN = requestType(SetupPacket.DIR_DEVICE_TO_HOST,
+        SetupPacket.TYPE_STANDARD, SetupPacket.RCPT_ENDPOINT)
+
+class USBDevice:
+    # descriptors is a DescriptorTable, ep0Size the maximum packet size of the
+    # control endpoint
+    def __init__(self, u, descriptors, ep0Size = 32, trace = None):
+        self.u = u
+        self.descriptors = descriptors
+        self.ep0Size = ep0Size
+        self.trace = trace if trace is not None else Tracer(INFO)
+
+        # (bmRequestType, bRequest) -> (name, handler)
+        self.handlers = {}
+
+        # we don't support remote wakeup or endpoint halting
+        for bmRequestType in [STANDARD_DEVICE_IN, STANDARD_INTERFACE_IN,
+                STANDARD_ENDPOINT_IN]:
+            self.registerStatic(bmRequestType, REQUEST_CODE['GET_STATUS'],
+                    '\x00\x00', 'GET_STATUS')
+
+        # class descriptors (e.g., HID report descriptors) are requested
+        # from the interface
+        for bmRequestType in [STANDARD_DEVICE_IN, STANDARD_INTERFACE_IN]:
+            self.register(bmRequestType, REQUEST_CODE['GET_DESCRIPTOR'],
+                    self.getDescriptor, 'GET_DESCRIPTOR')
+
+        self.register(STANDARD_DEVICE_OUT, REQUEST_CODE['SET_ADDRESS'],
+                self.setAddress, 'SET_ADDRESS')
+        self.register(STANDARD_DEVICE_IN, REQUEST_CODE['GET_CONFIGURATION'],
+                self.getConfiguration, 'GET_CONFIGURATION')
+        self.register(STANDARD_DEVICE_OUT, REQUEST_CODE['SET_CONFIGURATION'],
+                self.setConfiguration, 'SET_CONFIGURATION')
+
+    # handler is called with the SetupPacket of the request
+    def register(self, bmRequestType, bRequest, handler, name = None):
+        if name is None:
+            name = '0x%02x/%d' % (bmRequestType, bRequest)
+        self.handlers[(bmRequestType, bRequest)] = (name, handler)
+
+    # registers a request answered with the same data every time
+    def registerStatic(self, bmRequestType, bRequest, data, name = None):
+        data = memoryview(str(data))
+        self.register(bmRequestType, bRequest,
+                lambda stp: self.controlIn(data, stp), name)
+
+    def unregister(self, bmRequestType, bRequest):
+        del self.handlers[(bmRequestType, bRequest)]
+
+    # control transfer helpers
+
+    # completes the status stage of a request without data stage
+    def ack(self):
+        self.u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
+
+    def stall(self):
+        self.u.write('UECONX', (1 << STALLRQ) | (1 << EPEN))
+
+    def controlIn(self, data, stp):
+        if not self.u.controlIn(data, stp.length, self.ep0Size):
+            self.trace.warning("[-] Sending data stage aborted")
+            return False
+        return True
+
+    # standard requests
+
+    def getDescriptor(self, stp):
+        desc = self.descriptors.get(stp.descriptor_type,
+                stp.descriptor_index, stp.index, stp.length)
+        if desc is None:
+            self.trace.warning("[-] Unknown descriptor, stalling")
+            self.stall()
+        else:
+            self.controlIn(desc, stp)
+
+    def setAddress(self, stp):
+        self.ack()
+        self.u.waitForInterrupt('UEINTX', 1 << TXINI)
+        self.u.write('UDADDR', stp.value | (1 << ADDEN))
+
+    def getConfiguration(self, stp):
+        self.controlIn(chr(self.u.configuration or 0), stp)
+
+    def setConfiguration(self, stp):
+        self.u.configuration = stp.value
+        with self.u.transaction():
+            self.ack()
+            self.configure(stp.value)
+
+            # select control EP again
+            self.u.write('UENUM', 0)
+
+    # sets up the endpoints of a configuration (called within the
+    # transaction acknowledging SET_CONFIGURATION)
+    def configure(self, value):
+        pass
+
+    # resets the state of the device class when it is enumerated again
+    def reset(self):
+        pass
+
+    # detaches and attaches the device so that the host enumerates it again
+    # (see TeensyUSBProxy.reenumerate())
+    def reenumerate(self):
+        self.u.reenumerate()
+        self.reset()
+
+    # lets the Teensy answer GET_DESCRIPTOR, GET_STATUS and GET_CONFIGURATION
+    # from the descriptors, returns False if not all of them could be stored
+    def upload(self):
+        missing = self.u.uploadDescriptors(self.descriptors, self.ep0Size)
+        for key in missing:
+            self.trace.warning("[-] Descriptor %r not stored on the Teensy",
+                    key)
+        return not missing
+
+    # handles pending USB events, returns the setup packet of a handled
+    # request (if any)
+    def poll(self):
+        u = self.u
+        regs = u.read_many(['UDINT', 'UEINTX'])
+        udint = regs['UDINT']
+        ueint = regs['UEINTX']
+
+        if udint:
+            # only clear the interrupts seen
+            u.write('UDINT', ~udint & 0xff)
+
+        if udint & (1 << EORSTI):
+            self.trace.debug('[*] found EORSTI')
+            # the bus reset resets the endpoint configuration and the address,
+            # the host enumerates the device from scratch
+            u.invalidate()
+            u.configuration = None
+            self.reset()
+            u.setupEndpoint(0, EP_TYPE_CONTROL, self.ep0Size)
+
+        if not ueint & (1 << RXSTPI):
+            return None
+
+        self.trace.debug('[*] found RXSTPI')
+        if u.descriptorStore:
+            # the Teensy read the setup packet (unless it answered it)
+            with u.transaction():
+                u.write('UENUM', 0)
+                data = u.readSetup()
+            if data is None:
+                return None
+        else:
+            with u.transaction() as tx:
+                u.write('UENUM', 0)
+
+                # read 8 byte setup packet
+                i = tx.read('UEDATX', 8)
+                u.write('UEINTX', chr(~((1<<RXSTPI) | (1<<RXOUTI) | (1<<TXINI)) & 0xff))
+            data = tx.results[i]
+        stp = SetupPacket(data)
+        self.trace.debug(lambda: '[*] setup packet: %r' % stp.dissect())
+
+        t = time.time()
+        handler = self.handlers.get((stp.bmRequestType, stp.bRequest))
+        if handler is None:
+            name = 'unsupported'
+            self.trace.warning("[-] Unsupported request %r, stalling", stp)
+            self.stall()
+        else:
+            name, f = handler
+            self.trace.info("[*] received %s request", name)
+            f(stp)
+        u.metrics.request(name, time.time() - t)
+        return stp
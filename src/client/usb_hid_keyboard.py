@@ -2,16 +2,33 @@
 
 import serial, sys
 
-from usb_20 import *
+from usb_20_defs import *
 from class_code import CLASS_CODE
-from hid_11 import *
+from descriptor_table import DescriptorTable
+from hid_11_defs import *
+from hid_stream import ReportStreamer
+from hid_text import compileText
 from langid import LANGID
+from setup_packet import SetupPacket
 from teensy_usb_proxy import *
+from tracing import *
+from usb_device import *
 
 
+# baud rate of the serial link (after switching from the initial 57600 baud)
+BAUDRATE = 1000000
+
+# maximum packet size of the control endpoint
+EP0_SIZE = 32
+
+# interrupt IN endpoint of the keyboard reports
+REPORT_EP       = 3
+REPORT_SIZE     = 8
+REPORT_INTERVAL = 1
+
 # USB Device Class Definition for HID, Version 1.11
 # Section B.1, Protocol 1 (Keyboard)
-KEYBOARD_REPORT_DESCRIPTOR = ReportDescriptor(
+KEYBOARD_REPORT_DESCRIPTOR = (
           "\x05\x01"
         + "\x09\x06"
         + "\xA1\x01"
@@ -46,53 +63,42 @@ KEYBOARD_REPORT_DESCRIPTOR = ReportDescriptor(
         + "\xc0"
         )
 
-KEYBOARD_HID_DESCRIPTOR = Descriptor(
-        descriptor_type = DESCRIPTOR_TYPE['HID']) / \
-                HIDDescriptor(
-                        num_descriptors = 1,
-                        descriptors = [
-                            DescriptorTypeLength(
-                                descriptor_type = DESCRIPTOR_TYPE['Report'],
-                                descriptor_length = len(KEYBOARD_REPORT_DESCRIPTOR),
-                                ),])
+KEYBOARD_HID_DESCRIPTOR = hidDescriptor(
+        [(DESCRIPTOR_TYPE['Report'], len(KEYBOARD_REPORT_DESCRIPTOR))])
 
 DESCRIPTORS = {
         DESCRIPTOR_TYPE['CONFIGURATION'] : {
             0 : {
-                0 : Descriptor(length = 9, descriptor_type = DESCRIPTOR_TYPE['CONFIGURATION']) / \
-                        ConfigurationDescriptor(
-                            num_interfaces = 1,
-                            configuration_value = 1,
-                            configuration = 0) / \
-                        Descriptor(descriptor_type = DESCRIPTOR_TYPE['INTERFACE']) / \
-                            InterfaceDescriptor(
-                                num_endpoints = 1,
-                                interface_class = CLASS_CODE['HID'],
-                                interface_subclass = SUBCLASS_CODE['Boot'],
-                                interface_protocol = PROTOCOL_CODE['Keyboard'],
-                                ) / \
-                        KEYBOARD_HID_DESCRIPTOR / \
-                        Descriptor(descriptor_type = DESCRIPTOR_TYPE['ENDPOINT']) / \
-                            EndpointDescriptor(
-                                endpoint_direction = EndpointDescriptor.IN,
-                                endpoint_number = 3,
-                                transfer_type = EndpointDescriptor.INTERRUPT,
-                                max_packet_size = 8,
-                                interval = 1,
-                                ),
+                0 : configurationDescriptor([
+                        interfaceDescriptor(
+                            num_endpoints = 1,
+                            interface_class = CLASS_CODE['HID'],
+                            interface_subclass = SUBCLASS_CODE['Boot'],
+                            interface_protocol = PROTOCOL_CODE['Keyboard'],
+                            ),
+                        KEYBOARD_HID_DESCRIPTOR,
+                        endpointDescriptor(
+                            endpoint_direction = ENDPOINT_IN,
+                            endpoint_number = REPORT_EP,
+                            transfer_type = ENDPOINT_INTERRUPT,
+                            max_packet_size = REPORT_SIZE,
+                            interval = REPORT_INTERVAL,
+                            ),
+                        ],
+                        configuration_value = 1,
+                        configuration = 0),
                 },
             },
         DESCRIPTOR_TYPE['DEVICE'] : {
             0 : {
-                0 : Descriptor(descriptor_type = DESCRIPTOR_TYPE['DEVICE']) / \
-                        DeviceDescriptor(
-                            max_packet_size_0 = 32,
-                            id_vendor = 0x26C0,
-                            id_product = 0x247C,
-                            device = 0x0100,
-                            manufacturer = 1,
-                            product = 2,
-                            num_configurations = 1),
+                0 : deviceDescriptor(
+                        max_packet_size_0 = EP0_SIZE,
+                        id_vendor = 0x26C0,
+                        id_product = 0x247C,
+                        device = 0x0100,
+                        manufacturer = 1,
+                        product = 2,
+                        num_configurations = 1),
                 },
             },
         DESCRIPTOR_TYPE['HID'] : {
@@ -107,123 +113,101 @@ DESCRIPTORS = {
             },
         DESCRIPTOR_TYPE['STRING'] : {
             0 : {
-                0 : Descriptor(descriptor_type = DESCRIPTOR_TYPE['STRING']) / \
-                        StringDescriptorZero()
+                0 : stringDescriptorZero(),
                 },
             1 : {
-                LANGID['English (United States)'] : \
-                        Descriptor(descriptor_type = DESCRIPTOR_TYPE['STRING']) / \
-                        "TUP".encode('utf_16_le')
+                LANGID['English (United States)'] : stringDescriptor("TUP"),
                 },
             2 : {
                 LANGID['English (United States)'] : \
-                        Descriptor(descriptor_type = DESCRIPTOR_TYPE['STRING']) / \
-                        "Proxy Keyboard".encode('utf_16_le')
+                        stringDescriptor("Proxy Keyboard"),
                 },
             },
         }
 
-if __name__ == "__main__":
-    ser = serial.Serial('/dev/ttyUSB0', 57600, timeout = None)
+DESCRIPTOR_TABLE = DescriptorTable(DESCRIPTORS)
 
-    u = TeensyUSBProxy(ser)
-    u.init()
-    u.enable()
+trace = Tracer(INFO)
 
-    u.attach()
+HID_INTERFACE_OUT = requestType(SetupPacket.DIR_HOST_TO_DEVICE,
+        SetupPacket.TYPE_CLASS, SetupPacket.RCPT_INTERFACE)
+HID_INTERFACE_IN = requestType(SetupPacket.DIR_DEVICE_TO_HOST,
+        SetupPacket.TYPE_CLASS, SetupPacket.RCPT_INTERFACE)
+
+class HIDKeyboard(USBDevice):
+    # streamer sends the keyboard reports (and receives the idle rate set by
+    # the host)
+    def __init__(self, u, streamer = None, trace = trace):
+        USBDevice.__init__(self, u, DESCRIPTOR_TABLE, EP0_SIZE, trace)
+        if streamer is None:
+            streamer = ReportStreamer(u, REPORT_EP, REPORT_SIZE,
+                    REPORT_INTERVAL)
+        self.streamer = streamer
 
-    while True:
-        udint = ord(u.read('UDINT'))
-        u.write('UDINT', 0)
-        if udint & (1 << EORSTI):
-            print '[*] found EORSTI'
-            u.setupEndpoint(0, EP_TYPE_CONTROL, 32)
-
-        ueint = ord(u.read('UEINTX'))
-        if ueint & (1 << RXSTPI):
-            print '[*] found RXSTPI'
-            u.write('UENUM', 0)
-
-            # read 8 byte setup packet
-            p = u.readPacket(8)
-            u.write('UEINTX', chr(~((1<<RXSTPI) | (1<<RXOUTI) | (1<<TXINI)) & 0xff))
-            stp = Setup(p)
-            print '[*] setup packet:'
-            stp.show2()
-
-            if stp.request == REQUEST_CODE['GET_CONFIGURATION']:
-                print "[*] received GET_CONFIGURATION request"
-                # wait for IN packet
-                u.waitForInterrupt('UEINTX', 1 << TXINI)
-
-                # send active configuration
-                u.write('UEDATX', chr(u.configuration))
-
-                # inform host about IN packet
-                u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
-
-            elif stp.request == REQUEST_CODE['GET_DESCRIPTOR']:
-                print "[*] received GET_DESCRIPTOR request"
-                # wait for IN packet
-                u.waitForInterrupt('UEINTX', 1 << TXINI)
-
-                try:
-                    desc = str(DESCRIPTORS[stp.descriptor_type][stp.descriptor_index][stp.index])
-                    if len(desc) > stp.length:
-                        print "[*] truncating descriptor"
-                        desc = desc[0:stp.length]
-
-                    # wait for IN packet
-                    u.waitForInterrupt('UEINTX', 1 << TXINI)
-
-                    # send descriptor
-                    u.write('UEDATX', str(desc))
-
-                    # inform host about IN packet
-                    u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
-                except:
-                    print "[-] Unknown descriptor, stalling"
-                    u.write('UECONX', (1 << STALLRQ) | (1 << EPEN))
-
-            elif stp.request == REQUEST_CODE['SET_ADDRESS']:
-                print "[*] received SET_ADDRESS request"
-                u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
-                u.waitForInterrupt('UEINTX', 1 << TXINI)
-                u.write('UDADDR', stp.value | (1 << ADDEN))
-
-            elif stp.request == REQUEST_CODE['SET_CONFIGURATION']:
-                print "[*] received SET_CONFIGURATION request"
-                config = stp.value
-                u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
-
-                # configure EP 3
-                u.write('UENUM', '\x03')
-                # enable endpoint
-                u.write('UECONX',  (1 << EPEN))
-                # interrupt IN endpoint
-                u.write('UECFG0X', (1 << EPTYPE1) | (1 << EPTYPE0) | (1 << EPDIR))
-                u.write('UECFG1X', (1 << EPBK0))
-
-                # disable EP 1,2, and 4
-                for ep in [1, 2, 4]:
-                    u.write('UENUM', chr(ep))
-                    u.write('UECONX', '\x00')
-
-                u.write('UERST', '\x1e\x00')
-
-            elif stp.request == REQUEST_CODE['GET_CONFIGURATION']:
-                print "[*] received GET_CONFIGURATION request"
-                u.waitForInterrupt('UEINTX', 1 << TXINI)
-                u.write('UEDATX', config)
-                u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
-
-            elif stp.request == REQUEST_CODE['GET_STATUS']:
-                print "[*] received GET_STATUS request"
-                # we don't support endpoint halting
-                u.write('UEDATX', '\x00\x00')
-                u.write('UEINTX', chr(~(1<<TXINI) & 0xff))
+        self.register(HID_INTERFACE_OUT, HID_REQUEST_CODE['SET_IDLE'],
+                self.setIdle, 'SET_IDLE')
+        self.register(HID_INTERFACE_IN, HID_REQUEST_CODE['GET_IDLE'],
+                self.getIdle, 'GET_IDLE')
 
+    def setIdle(self, stp):
+        self.streamer.setIdle(stp.value >> 8)
+        self.ack()
 
+    def getIdle(self, stp):
+        self.controlIn(chr(self.streamer.getIdle()), stp)
 
+    def reset(self):
+        self.streamer.reset()
 
+    def configure(self, value):
+        u = self.u
+
+        # configure EP 3
+        u.write('UENUM', REPORT_EP)
+        # enable endpoint
+        u.write('UECONX',  (1 << EPEN))
+        # interrupt IN endpoint
+        u.write('UECFG0X', (1 << EPTYPE1) | (1 << EPTYPE0) | (1 << EPDIR))
+        # double bank, allocate the endpoint memory
+        u.write('UECFG1X', EP_SIZE[REPORT_SIZE] | (1 << EPBK0) | (1 << ALLOC))
+
+        # disable EP 1,2, and 4
+        for ep in [1, 2, 4]:
+            u.write('UENUM', chr(ep))
+            u.write('UECONX', '\x00')
+
+        u.write('UERST', '\x1e\x00')
+
+if __name__ == "__main__":
+    ser = serial.Serial('/dev/ttyUSB0', BOOT_BAUDRATE, timeout = None)
+
+    u = TeensyUSBProxy(ser, shadow = True)
+    # the Teensy still runs at the rate of a previous client
+    if not u.resync(BAUDRATE):
+        trace.warning("[-] Switching to %d baud failed", BAUDRATE)
+        if not u.resync():
+            sys.exit("[-] Teensy not responding")
+    u.init()
+    u.enable()
+
+    u.attach()
 
+    # keep recent events for post-mortem analysis
+    trace = Tracer(INFO, ring = 1024)
+    keyboard = HIDKeyboard(u, trace = trace)
+    # let the Teensy answer the standard requests
+    keyboard.upload()
+    # type the text given on the command line once configured (the bus
+    # reset by the host drops queued reports)
+    text = compileText(sys.argv[1].decode('utf-8')) if len(sys.argv) > 1 \
+            else ()
+    try:
+        while True:
+            keyboard.poll()
+            if text and u.configuration:
+                keyboard.streamer.extend(text)
+                text = ()
+            keyboard.streamer.service()
+    except:
+        trace.dump(sys.stderr)
+        raise
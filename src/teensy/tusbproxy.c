@@ -2,7 +2,10 @@
  * tusbproxy -- Teensy USB proxy
  */
 
+#include <avr/interrupt.h>
 #include <avr/pgmspace.h>
+#include <util/atomic.h>
+#include <util/delay.h>
 
 #include "uart.h"
 
@@ -18,6 +21,533 @@
 #define SMALL_COUNT_MASK 0x20
 #define COUNT_MASK       0x1F
 
+// Extended commands are encoded as reads of zero bytes (which are no-ops
+// otherwise). The register type bit selects the register space the command
+// operates on, the byte following the command byte is the extended opcode.
+#define CMD_EXT          0x20
+#define CMD_EXT_MASK     0xBF
+#define TYPE_MEM8        0x40
+
+// wait until (reg & mask) != 0 or a timeout (in ms, 0 = read once) expires;
+// the wait is always bounded so that the board keeps reading commands, the
+// client re-issues the command to wait longer
+// args: reg, mask, timeout (16 bit, little endian)
+// returns: final value of reg
+#define EXT_POLL         0x01
+
+// reg = (reg & ~clear) | set, executed atomically
+// args: reg, clear, set
+#define EXT_MODIFY       0x02
+
+// read a list of registers (I/O registers via their data space address)
+// args: n, n addresses
+// returns: n register values
+#define EXT_GATHER       0x03
+
+// switch the baud rate, falls back to the current rate unless the client
+// confirms the new one by sending BAUD_SYNC within 100 ms; a break returns to
+// the initial rate at any time (see uart.h)
+// args: UBRR1 value (16 bit, little endian, double speed mode)
+// returns: BAUD_ACK (at the current rate), BAUD_SYNC (at the new rate)
+#define EXT_BAUD         0x04
+
+#define BAUD_ACK         0xA5
+#define BAUD_SYNC        0x5A
+
+// Descriptor store: the client uploads the serialized descriptors of the
+// emulated device, standard GET_DESCRIPTOR, GET_STATUS and GET_CONFIGURATION
+// requests are then answered by the USB interrupt without involving the
+// client. Other setup packets are stashed for the client (see EXT_SETUP).
+// The USB interrupt never waits for the host: the packets of the data stage
+// are sent as the bank becomes free (TXINI), and a bus reset aborts the
+// transfer.
+
+// clear the descriptor store and disable answering requests locally
+#define EXT_DESC_CLEAR   0x05
+
+// add a descriptor (only while disabled)
+// args: type, index, language id (16 bit), length (16 bit), descriptor
+// returns: 1 if the descriptor was stored, 0 if the store is full
+#define EXT_DESC_ADD     0x06
+
+// enable or disable answering requests locally
+// args: maximum packet size of EP 0, enable (0 or 1)
+#define EXT_DESC_ENABLE  0x07
+
+// read and acknowledge a setup packet not answered locally
+// returns: 1 and the setup packet if one is pending, 0 and 8 zeros otherwise
+#define EXT_SETUP        0x08
+
+// send a packet of a control IN data stage on the selected endpoint once the
+// bank is free (TXINI); the packet is dropped if the host aborted the data
+// stage (RXOUTI or RXSTPI), the wait timed out, or a previous packet of the
+// transfer was dropped, so the client can pipeline all packets of a transfer
+// args: flags (IN_FIRST for the first packet of a transfer), timeout (in ms,
+//       16 bit, little endian), n (at most IN_PACKET_SIZE), n data bytes
+// returns: final value of UEINTX, 0 if the packet was not waited for
+#define EXT_IN_PACKET    0x09
+
+#define IN_FIRST         0x01
+#define IN_PACKET_SIZE   64
+
+#define DESC_SIZE        2048
+#define DESC_ENTRIES     32
+
+// USB 2.0, Table 9-4. Standard Request Codes
+#define GET_STATUS         0
+#define SET_ADDRESS        5
+#define GET_DESCRIPTOR     6
+#define GET_CONFIGURATION  8
+#define SET_CONFIGURATION  9
+
+struct desc_entry {
+    uint8_t type;
+    uint8_t index;
+    uint16_t langid;
+    uint16_t offset;
+    uint16_t length;
+};
+
+static uint8_t desc_data[DESC_SIZE];
+static struct desc_entry desc_table[DESC_ENTRIES];
+static uint8_t desc_count;
+static uint16_t desc_used;
+
+static volatile uint8_t setup_enabled;
+static volatile uint8_t setup_pending;
+static uint8_t setup_packet[8];
+static uint8_t ep0_size;
+
+// configuration set by the host (sniffed from SET_CONFIGURATION)
+static uint8_t usb_configuration;
+
+static const uint8_t usb_status[2] = {0, 0};
+
+// data stage of the control IN transfer answered locally
+static volatile uint8_t ctl_active;
+static const uint8_t *ctl_data;
+static uint16_t ctl_length;
+// a short transfer ending on a full packet needs a zero length packet
+static uint8_t ctl_zlp;
+
+// a packet of the control IN transfer sent by the client was dropped
+static uint8_t in_failed;
+
+static uint8_t reg_read(uint8_t type, uint8_t reg) {
+    if (type == TYPE_MEM8)
+        return _SFR_MEM8(reg);
+    else
+        return _SFR_IO8(reg);
+}
+
+static void reg_write(uint8_t type, uint8_t reg, uint8_t val) {
+    if (type == TYPE_MEM8)
+        _SFR_MEM8(reg) = val;
+    else
+        _SFR_IO8(reg) = val;
+}
+
+static void ext_poll(uint8_t type) {
+    uint8_t reg, mask, val;
+    uint16_t timeout;
+    uint32_t ticks;
+
+    reg = uart_getchar();
+    mask = uart_getchar();
+    timeout = uart_getchar();
+    timeout |= uart_getchar() << 8;
+
+    // poll every 10 us
+    ticks = (uint32_t) timeout * 100;
+
+    val = reg_read(type, reg);
+    while (!(val & mask) && ticks-- > 0) {
+        _delay_us(10);
+        val = reg_read(type, reg);
+    }
+
+    uart_putchar(val);
+}
+
+static void ext_modify(uint8_t type) {
+    uint8_t reg, clear, set;
+
+    reg = uart_getchar();
+    clear = uart_getchar();
+    set = uart_getchar();
+
+    ATOMIC_BLOCK(ATOMIC_RESTORESTATE) {
+        reg_write(type, reg, (reg_read(type, reg) & ~clear) | set);
+    }
+}
+
+static void ext_gather(void) {
+    uint8_t n;
+
+    n = uart_getchar();
+    while (n-- > 0)
+        uart_putchar(_SFR_MEM8(uart_getchar()));
+}
+
+static void ext_baud(void) {
+    uint16_t ubrr, old, i;
+
+    ubrr = uart_getchar();
+    ubrr |= uart_getchar() << 8;
+
+    old = uart_get_ubrr();
+
+    uart_putchar(BAUD_ACK);
+    uart_flush();
+    uart_set_ubrr(ubrr);
+
+    // wait for the client to confirm the new rate
+    for (i = 0; i < 10000 && !uart_available(); i++)
+        _delay_us(10);
+
+    if (uart_available() && uart_getchar() == BAUD_SYNC)
+        uart_putchar(BAUD_SYNC);
+    else
+        uart_set_ubrr(old);
+}
+
+static const struct desc_entry *desc_find(uint8_t type, uint8_t index,
+        uint16_t langid) {
+    uint8_t i;
+
+    for (i = 0; i < desc_count; i++) {
+        if (desc_table[i].type == type && desc_table[i].index == index &&
+                desc_table[i].langid == langid)
+            return &desc_table[i];
+    }
+    return 0;
+}
+
+// stops sending the data stage (EP 0 selected)
+static void control_end(void) {
+    ctl_active = 0;
+    UEIENX &= ~((1<<TXINE) | (1<<RXOUTE));
+}
+
+// acknowledges the setup packet and starts the data stage (EP 0 selected),
+// the packets are sent by control_next()
+static void control_in(const uint8_t *data, uint16_t length, uint16_t wLength) {
+    if (length > wLength)
+        length = wLength;
+
+    ctl_data = data;
+    ctl_length = length;
+    ctl_zlp = length < wLength && length % ep0_size == 0;
+    ctl_active = 1;
+
+    UEINTX = ~((1<<RXSTPI) | (1<<RXOUTI) | (1<<TXINI));
+    UEIENX |= (1<<TXINE) | (1<<RXOUTE);
+}
+
+// sends the next packet of the data stage once the bank is free, stops if
+// the host aborted the data stage (EP 0 selected)
+static void control_next(void) {
+    uint8_t i, n;
+
+    i = UEINTX;
+    if (i & (1<<RXOUTI)) {
+        control_end();
+        return;
+    }
+    if (!(i & (1<<TXINI)))
+        return;
+
+    n = ctl_length < ep0_size ? ctl_length : ep0_size;
+    for (i = n; i; i--)
+        UEDATX = *ctl_data++;
+    ctl_length -= n;
+    UEINTX = ~(1<<TXINI);
+
+    if (!ctl_length && (n < ep0_size || !ctl_zlp))
+        control_end();
+}
+
+// answers the setup packet locally, returns 0 if it is to be forwarded
+static uint8_t setup_local(void) {
+    uint8_t bmRequestType, bRequest;
+    uint16_t wValue, wIndex, wLength;
+    const struct desc_entry *desc;
+
+    bmRequestType = setup_packet[0];
+    bRequest = setup_packet[1];
+    wValue = setup_packet[2] | (setup_packet[3] << 8);
+    wIndex = setup_packet[4] | (setup_packet[5] << 8);
+    wLength = setup_packet[6] | (setup_packet[7] << 8);
+
+    switch (bRequest) {
+        case (GET_DESCRIPTOR):
+            // class descriptors are requested from the interface
+            if (bmRequestType != 0x80 && bmRequestType != 0x81)
+                return 0;
+            desc = desc_find(wValue >> 8, wValue & 0xff, wIndex);
+            if (!desc)
+                return 0;
+            control_in(desc_data + desc->offset, desc->length, wLength);
+            return 1;
+        case (GET_STATUS):
+            if (bmRequestType < 0x80 || bmRequestType > 0x82)
+                return 0;
+            control_in(usb_status, sizeof(usb_status), wLength);
+            return 1;
+        case (GET_CONFIGURATION):
+            if (bmRequestType != 0x80)
+                return 0;
+            control_in(&usb_configuration, 1, wLength);
+            return 1;
+        case (SET_ADDRESS):
+            if (bmRequestType == 0x00)
+                usb_configuration = 0;
+            return 0;
+        case (SET_CONFIGURATION):
+            if (bmRequestType == 0x00)
+                usb_configuration = wValue;
+            return 0;
+        default:
+            return 0;
+    }
+}
+
+ISR(USB_COM_vect) {
+    uint8_t ep, i;
+
+    // the client might have selected another endpoint
+    ep = UENUM;
+    UENUM = 0;
+
+    if (UEINTX & (1<<RXSTPI)) {
+        // a new setup packet ends the previous transfer
+        if (ctl_active)
+            control_end();
+
+        for (i = 0; i < sizeof(setup_packet); i++)
+            setup_packet[i] = UEDATX;
+
+        if (!setup_local()) {
+            // leave RXSTPI set for the client, the interrupt is enabled
+            // again once the client read the packet via EXT_SETUP
+            setup_pending = 1;
+            UEIENX &= ~(1<<RXSTPE);
+        }
+    } else if (ctl_active) {
+        control_next();
+    }
+
+    UENUM = ep;
+}
+
+// aborts the data stage on a bus reset; EORSTI is left for the client, hence
+// the interrupt stays disabled until the client cleared it (see setup_rearm())
+ISR(USB_GEN_vect) {
+    uint8_t ep;
+
+    if (UDINT & (1<<EORSTI)) {
+        UDIEN &= ~(1<<EORSTE);
+        if (ctl_active) {
+            ep = UENUM;
+            UENUM = 0;
+            control_end();
+            UENUM = ep;
+        }
+    }
+}
+
+// enables the setup interrupt of EP 0 and the bus reset interrupt (again),
+// e.g., after a bus reset
+static void setup_rearm(void) {
+    uint8_t ep;
+
+    if (!setup_enabled)
+        return;
+
+    ATOMIC_BLOCK(ATOMIC_RESTORESTATE) {
+        if (!(UDIEN & (1<<EORSTE)) && !(UDINT & (1<<EORSTI)))
+            UDIEN |= (1<<EORSTE);
+
+        if (!setup_pending) {
+            ep = UENUM;
+            UENUM = 0;
+            if ((UECONX & (1<<EPEN)) && !(UEIENX & (1<<RXSTPE)))
+                UEIENX |= (1<<RXSTPE);
+            UENUM = ep;
+        }
+    }
+}
+
+static void setup_disable(void) {
+    uint8_t ep;
+
+    ATOMIC_BLOCK(ATOMIC_RESTORESTATE) {
+        setup_enabled = 0;
+        UDIEN &= ~(1<<EORSTE);
+        ep = UENUM;
+        UENUM = 0;
+        UEIENX &= ~(1<<RXSTPE);
+        if (ctl_active)
+            control_end();
+        UENUM = ep;
+    }
+}
+
+static void ext_desc_add(void) {
+    uint8_t type, index, stored;
+    uint16_t langid, length, i;
+    struct desc_entry *desc;
+
+    type = uart_getchar();
+    index = uart_getchar();
+    langid = uart_getchar();
+    langid |= uart_getchar() << 8;
+    length = uart_getchar();
+    length |= uart_getchar() << 8;
+
+    stored = !setup_enabled && desc_count < DESC_ENTRIES &&
+        length <= DESC_SIZE - desc_used;
+    if (stored) {
+        desc = &desc_table[desc_count++];
+        desc->type = type;
+        desc->index = index;
+        desc->langid = langid;
+        desc->offset = desc_used;
+        desc->length = length;
+        for (i = 0; i < length; i++)
+            desc_data[desc_used++] = uart_getchar();
+    } else {
+        // drop the descriptor
+        for (i = 0; i < length; i++)
+            uart_getchar();
+    }
+
+    uart_putchar(stored);
+}
+
+static void ext_desc_enable(void) {
+    uint8_t size, enable;
+
+    size = uart_getchar();
+    enable = uart_getchar();
+
+    if (enable && size) {
+        ep0_size = size;
+        setup_enabled = 1;
+        setup_rearm();
+    } else {
+        setup_disable();
+    }
+}
+
+static void ext_setup(void) {
+    uint8_t packet[sizeof(setup_packet)];
+    uint8_t pending, ep, i;
+
+    ATOMIC_BLOCK(ATOMIC_RESTORESTATE) {
+        pending = setup_pending;
+        if (pending) {
+            for (i = 0; i < sizeof(packet); i++)
+                packet[i] = setup_packet[i];
+
+            ep = UENUM;
+            UENUM = 0;
+            UEINTX = ~((1<<RXSTPI) | (1<<RXOUTI) | (1<<TXINI));
+            UEIENX |= (1<<RXSTPE);
+            UENUM = ep;
+            setup_pending = 0;
+        }
+    }
+
+    // the UART needs interrupts for sending
+    uart_putchar(pending);
+    for (i = 0; i < sizeof(packet); i++)
+        uart_putchar(pending ? packet[i] : 0);
+}
+
+static void ext_in_packet(void) {
+    uint8_t packet[IN_PACKET_SIZE];
+    uint8_t flags, n, i, c, val;
+    uint16_t timeout;
+    uint32_t ticks;
+
+    flags = uart_getchar();
+    timeout = uart_getchar();
+    timeout |= uart_getchar() << 8;
+    n = uart_getchar();
+
+    // the data is read before waiting, it is part of the command even if
+    // the packet is dropped
+    for (i = 0; i < n; i++) {
+        c = uart_getchar();
+        if (i < sizeof(packet))
+            packet[i] = c;
+    }
+
+    if (flags & IN_FIRST)
+        in_failed = 0;
+    if (n > sizeof(packet))
+        in_failed = 1;
+
+    val = 0;
+    if (!in_failed) {
+        ticks = (uint32_t) timeout * 100;
+
+        val = UEINTX;
+        while (!(val & ((1<<TXINI) | (1<<RXOUTI) | (1<<RXSTPI))) &&
+                ticks-- > 0) {
+            _delay_us(10);
+            val = UEINTX;
+        }
+
+        if ((val & (1<<TXINI)) && !(val & ((1<<RXOUTI) | (1<<RXSTPI)))) {
+            for (i = 0; i < n; i++)
+                UEDATX = packet[i];
+            UEINTX = ~(1<<TXINI);
+        } else {
+            in_failed = 1;
+        }
+    }
+
+    uart_putchar(val);
+}
+
+static void ext_command(uint8_t type, uint8_t op) {
+    switch (op) {
+        case (EXT_POLL):
+            ext_poll(type);
+            break;
+        case (EXT_MODIFY):
+            ext_modify(type);
+            break;
+        case (EXT_GATHER):
+            ext_gather();
+            break;
+        case (EXT_BAUD):
+            ext_baud();
+            break;
+        case (EXT_DESC_CLEAR):
+            setup_disable();
+            desc_count = 0;
+            desc_used = 0;
+            break;
+        case (EXT_DESC_ADD):
+            ext_desc_add();
+            break;
+        case (EXT_DESC_ENABLE):
+            ext_desc_enable();
+            break;
+        case (EXT_SETUP):
+            ext_setup();
+            break;
+        case (EXT_IN_PACKET):
+            ext_in_packet();
+            break;
+        default:
+            break;
+    }
+}
+
 int main(void) {
     uint8_t cmd, val;
     uint16_t count, i;
@@ -28,10 +558,22 @@ int main(void) {
 
     uart_init(57600);
 
+    // a break aborts the command being read (the client resynchronizes the
+    // baud rate, see TeensyUSBProxy.resync())
+    setjmp(uart_break_env);
+
     while (1) {
 
+        while (!uart_available())
+            setup_rearm();
+
         cmd = uart_getchar();
 
+        if ((cmd & CMD_EXT_MASK) == CMD_EXT) {
+            ext_command(cmd & TYPE_MEM8, uart_getchar());
+            continue;
+        }
+
         // determine how many bytes to read or write
         if (cmd & SMALL_COUNT_MASK)
             count = cmd & COUNT_MASK;
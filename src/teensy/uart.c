@@ -42,20 +42,57 @@ static volatile uint16_t tx_buffer_tail;
 static volatile uint8_t rx_buffer[RX_BUFFER_SIZE];
 static volatile uint16_t rx_buffer_head;
 static volatile uint16_t rx_buffer_tail;
+static volatile uint8_t tx_pending;
+static volatile uint8_t break_received;
+static uint16_t boot_ubrr;
+
+// uart_getchar() jumps here after a break was received
+jmp_buf uart_break_env;
 
 // Initialize the UART
 void uart_init(uint32_t baud)
 {
     cli();
-    UBRR1 = (F_CPU / 4 / baud - 1) / 2;
+    boot_ubrr = (F_CPU / 4 / baud - 1) / 2;
+    UBRR1 = boot_ubrr;
     UCSR1A = (1<<U2X1);
     UCSR1B = (1<<RXEN1) | (1<<TXEN1) | (1<<RXCIE1);
     UCSR1C = (1<<UCSZ11) | (1<<UCSZ10);
     tx_buffer_head = tx_buffer_tail = 0;
     rx_buffer_head = rx_buffer_tail = 0;
+    tx_pending = 0;
+    break_received = 0;
     sei();
 }
 
+// Change the baud rate (UBRR1 value, double speed mode) and drop all bytes
+// received so far, a pending break takes precedence
+void uart_set_ubrr(uint16_t ubrr)
+{
+    cli();
+    if (!break_received) {
+        UBRR1 = ubrr;
+        rx_buffer_head = rx_buffer_tail = 0;
+    }
+    sei();
+}
+
+// Return the current UBRR1 value
+uint16_t uart_get_ubrr(void)
+{
+    return UBRR1;
+}
+
+// Wait until all bytes have been transmitted
+void uart_flush(void)
+{
+    while (tx_buffer_head != tx_buffer_tail) ;
+    if (tx_pending) {
+        while (!(UCSR1A & (1<<TXC1))) ;
+        tx_pending = 0;
+    }
+}
+
 // Transmit a byte
 void uart_putchar(uint8_t c)
 {
@@ -67,17 +104,27 @@ void uart_putchar(uint8_t c)
     //cli();
     tx_buffer[i] = c;
     tx_buffer_head = i;
+    // clear transmit complete flag (set again when all bytes have been sent)
+    UCSR1A = (1<<U2X1) | (1<<TXC1);
+    tx_pending = 1;
     UCSR1B = (1<<RXEN1) | (1<<TXEN1) | (1<<RXCIE1) | (1<<UDRIE1);
     //sei();
 }
 
-// Receive a byte
+// Receive a byte, jumps to uart_break_env instead if a break was received
+// since the last call
 uint8_t uart_getchar(void)
 {
     uint8_t c;
     uint16_t i;
 
-    while (rx_buffer_head == rx_buffer_tail) ; // wait for character
+    // wait for character
+    while (break_received || rx_buffer_head == rx_buffer_tail) {
+        if (break_received) {
+            break_received = 0;
+            longjmp(uart_break_env, 1);
+        }
+    }
     i = rx_buffer_tail + 1;
     if (i >= RX_BUFFER_SIZE) i = 0;
     c = rx_buffer[i];
@@ -117,10 +164,22 @@ ISR(USART1_UDRE_vect)
 // Receive Interrupt
 ISR(USART1_RX_vect)
 {
-    uint8_t c;
+    uint8_t c, status;
     uint16_t i;
 
+    status = UCSR1A;
     c = UDR1;
+    // a zero byte without stop bit is a break (or a byte sent at a lower
+    // rate), return to the initial rate and drop the bytes received so far
+    // as well as the replies not sent yet (the client would read them at the
+    // wrong rate)
+    if ((status & (1<<FE1)) && c == 0) {
+        UBRR1 = boot_ubrr;
+        rx_buffer_head = rx_buffer_tail;
+        tx_buffer_tail = tx_buffer_head;
+        break_received = 1;
+        return;
+    }
     i = rx_buffer_head + 1;
     if (i >= RX_BUFFER_SIZE) i = 0;
     if (i != rx_buffer_tail) {
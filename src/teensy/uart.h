@@ -1,11 +1,19 @@
 #ifndef _uart_included_h_
 #define _uart_included_h_
 
+#include <setjmp.h>
 #include <stdint.h>
 
+// On a break, the UART returns to the baud rate passed to uart_init() and
+// uart_getchar() jumps to uart_break_env (to be set by the caller)
+extern jmp_buf uart_break_env;
+
 void uart_init(uint32_t baud);
 void uart_putchar(uint8_t c);
 uint8_t uart_getchar(void);
 uint16_t uart_available(void);
+void uart_set_ubrr(uint16_t ubrr);
+uint16_t uart_get_ubrr(void);
+void uart_flush(void);
 
 #endif